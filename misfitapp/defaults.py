@@ -23,3 +23,64 @@ MISFIT_ERROR_TEMPLATE = 'misfit/error.html'
 # called with the request as the only parameter to get the final value for the
 # message.
 MISFIT_DECORATOR_MESSAGE = 'This page requires Misfit integration.'
+
+# The number of date chunks fetched from the Misfit API in parallel for a
+# single user during a historical import. Chunks are still written to the
+# database in order. The default of 1 fetches chunks sequentially.
+MISFIT_IMPORT_CONCURRENCY = 1
+
+# How long, in seconds, the certificates used to verify the signatures of
+# Misfit notifications are cached, and how many of them each process keeps.
+MISFIT_SIGNING_CERT_TIMEOUT = 60 * 60 * 24
+MISFIT_SIGNING_CERT_CACHE_SIZE = 16
+
+# The maximum number of Misfit API clients (and their keep-alive HTTP
+# connections) kept per process for reuse. The least recently used clients
+# are discarded first.
+MISFIT_CLIENT_POOL_SIZE = 128
+
+# If set, notification messages are buffered for this many seconds per Misfit
+# user and message type, and only the latest message for each object is
+# processed. This saves API calls and database writes when Misfit sends bursts
+# of updates for the same objects. The default of 0 processes messages as soon
+# as they arrive. The buffers are kept in the Django cache, so this requires a
+# cache backend shared by all web and Celery worker processes, such as
+# memcached or Redis, and not the default per-process LocMemCache.
+MISFIT_NOTIFICATION_COALESCE_WINDOW = 0
+
+# How long, in seconds, processed notification messages are remembered.
+# Duplicate messages received within this time are ignored.
+MISFIT_PROCESSED_MESSAGE_TTL = 60 * 60 * 24
+
+# Token bucket rate limits applied to the Misfit API calls made by all
+# workers, for the whole app and for each user. Each is None to disable it,
+# or a (requests, seconds) tuple. Calls beyond the limit raise
+# MisfitRateLimitError without calling the API, and tasks retry them later.
+MISFIT_APP_RATE_LIMIT = None
+MISFIT_USER_RATE_LIMIT = None
+
+# The options, such as queue and priority, that the Celery tasks of each lane
+# are sent with. The 'live' lane processes notifications, the 'refresh' lane
+# updates summaries after goals change and the 'backfill' lane imports the
+# historical data of new users. For example, to keep notifications from
+# waiting behind backfills, route them to queues with their own workers:
+# {'live': {'queue': 'misfit-live'}, 'backfill': {'queue': 'misfit-backfill'}}
+MISFIT_TASK_LANES = {'live': {}, 'refresh': {}, 'backfill': {}}
+
+# Whether sleep segments are also stored as one SleepSegment row each. They
+# are always stored packed in Sleep.packed_segments, see Sleep.get_segments.
+# Set this to False to stop writing to the (large) SleepSegment table.
+MISFIT_SLEEP_SEGMENT_ROWS = True
+
+# How long, in seconds, whether a user is integrated with Misfit is cached,
+# see utils.is_integrated. The cache is cleared when a MisfitUser is saved or
+# deleted, so this only bounds how long changes made without signals, such as
+# queryset updates, take to show.
+MISFIT_INTEGRATION_CACHE_TIMEOUT = 60 * 60
+
+# How old, in seconds, a user's stored profile can get before logging in
+# refreshes it from Misfit in the background. Logging in puts the stored
+# profile in the session without waiting for the refresh. Refreshes of each
+# user's profile are started at most once per throttle period, in seconds.
+MISFIT_PROFILE_MAX_AGE = 60 * 60 * 24
+MISFIT_PROFILE_REFRESH_THROTTLE = 60 * 15
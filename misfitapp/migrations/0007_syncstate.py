@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('misfitapp', '0006_fkunique_to_onetoone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.CharField(choices=[('Summary', 'Summary'), ('Goal', 'Goal'), ('Session', 'Session'), ('Sleep', 'Sleep')], help_text='The type of data being synced, one of: Summary, Goal, Session, Sleep', max_length=15)),
+                ('high_water_date', models.DateField(blank=True, help_text='Date up to which data has been imported', null=True)),
+                ('last_success', models.DateTimeField(blank=True, help_text='Datetime of the last successful import', null=True)),
+                ('user', models.ForeignKey(help_text="The sync state's user", on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='syncstate',
+            unique_together=set([('user', 'resource_type')]),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('misfitapp', '0007_syncstate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportProgress',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resource_type', models.CharField(choices=[('Profile', 'Profile'), ('Device', 'Device'), ('Summary', 'Summary'), ('Goal', 'Goal'), ('Session', 'Session'), ('Sleep', 'Sleep')], help_text='The type of data being imported, one of: Profile, Device, Summary, Goal, Session, Sleep', max_length=15)),
+                ('chunks_done', models.IntegerField(default=0, help_text='Number of chunks imported so far')),
+                ('chunks_total', models.IntegerField(default=0, help_text='Number of chunks to import')),
+                ('rows', models.IntegerField(default=0, help_text='Number of objects imported so far')),
+                ('started', models.DateTimeField(blank=True, help_text='Datetime when the import started', null=True)),
+                ('finished', models.DateTimeField(blank=True, help_text='Datetime when the import finished', null=True)),
+                ('failed', models.BooleanField(default=False, help_text='Whether the import finished with an error')),
+                ('user', models.ForeignKey(help_text="The import's user", on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='importprogress',
+            unique_together=set([('user', 'resource_type')]),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('misfitapp', '0008_importprogress'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='goal',
+            index_together=set([('user', 'date', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='session',
+            index_together=set([('user', 'start_time', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='sleep',
+            index_together=set([('user', 'start_time', 'id')]),
+        ),
+    ]
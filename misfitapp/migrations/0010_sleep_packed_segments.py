@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import struct
+
+from itertools import groupby
+from operator import itemgetter
+
+from django.db import migrations, models
+
+
+# A copy of misfitapp.models.encode_sleep_segments as of this migration
+SLEEP_SEGMENT_STRUCT = struct.Struct('>iB')
+
+
+def encode_sleep_segments(start_time, segments):
+    return b''.join(
+        SLEEP_SEGMENT_STRUCT.pack(
+            int((time - start_time).total_seconds()), sleep_type)
+        for time, sleep_type in segments)
+
+
+def pack_segments(apps, schema_editor):
+    """ Pack the existing SleepSegment rows of each sleep """
+    Sleep = apps.get_model('misfitapp', 'Sleep')
+    SleepSegment = apps.get_model('misfitapp', 'SleepSegment')
+    # Read each sleep's start time along with its segments, so the only
+    # other query per sleep is its update
+    segments = SleepSegment.objects.order_by('sleep_id', 'time').values_list(
+        'sleep_id', 'sleep__start_time', 'time', 'sleep_type').iterator()
+    for (sleep_id, start_time), rows in groupby(segments, itemgetter(0, 1)):
+        Sleep.objects.filter(pk=sleep_id).update(
+            packed_segments=encode_sleep_segments(
+                start_time, [row[2:] for row in rows]))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('misfitapp', '0009_user_time_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sleep',
+            name='packed_segments',
+            field=models.BinaryField(blank=True, help_text='The sleep segments, packed by encode_sleep_segments', null=True),
+        ),
+        migrations.RunPython(pack_segments, migrations.RunPython.noop),
+    ]
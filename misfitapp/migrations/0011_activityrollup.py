@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('misfitapp', '0010_sleep_packed_segments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ActivityRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('week', 'week'), ('month', 'month')], help_text='The length of the period, one of: week, month', max_length=5)),
+                ('period_start', models.DateField(help_text='The first day of the period')),
+                ('points', models.FloatField(default=0, help_text='Total points')),
+                ('steps', models.BigIntegerField(default=0, help_text='Total steps')),
+                ('calories', models.FloatField(default=0, help_text='Total calories')),
+                ('activity_calories', models.FloatField(default=0, help_text='Total activity calories')),
+                ('distance', models.FloatField(default=0, help_text='Total distance traveled, in miles')),
+                ('days', models.IntegerField(default=0, help_text='Number of days with a summary')),
+                ('goals', models.IntegerField(default=0, help_text='Number of goals')),
+                ('goals_met', models.IntegerField(default=0, help_text='Number of goals whose target points were met')),
+                ('user', models.ForeignKey(help_text="The rollup's user", on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='activityrollup',
+            unique_together=set([('user', 'period', 'period_start')]),
+        ),
+    ]
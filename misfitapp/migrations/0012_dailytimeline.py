@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('misfitapp', '0011_activityrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyTimeline',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(help_text='The date of the timeline entry')),
+                ('steps', models.IntegerField(blank=True, help_text='Steps for the day, from Summary', null=True)),
+                ('points', models.FloatField(blank=True, help_text='Points for the day, from Summary', null=True)),
+                ('target_points', models.IntegerField(blank=True, help_text='Target points for the day, from Goal', null=True)),
+                ('sleep_duration', models.IntegerField(default=0, help_text='Seconds asleep, including deep sleep')),
+                ('deep_sleep_duration', models.IntegerField(default=0, help_text='Seconds in deep sleep')),
+                ('user', models.ForeignKey(help_text="The timeline's user", on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailytimeline',
+            unique_together=set([('user', 'date')]),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('misfitapp', '0012_dailytimeline'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserSnapshot',
+            fields=[
+                ('misfit_user', models.OneToOneField(help_text="The snapshot's Misfit user", on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='misfitapp.MisfitUser')),
+                ('battery_level', models.SmallIntegerField(blank=True, help_text="Percentage battery remaining of the user's device", null=True)),
+                ('last_sync_time', models.DateTimeField(blank=True, help_text="Datetime the user's device was last synced", null=True)),
+                ('summary_date', models.DateField(blank=True, help_text='The date of the latest summary', null=True)),
+                ('steps', models.IntegerField(blank=True, help_text='Steps of the latest summary', null=True)),
+                ('points', models.FloatField(blank=True, help_text='Points of the latest summary', null=True)),
+                ('goal_date', models.DateField(blank=True, help_text='The date of the latest goal', null=True)),
+                ('goal_points', models.FloatField(blank=True, help_text='Points of the latest goal', null=True)),
+                ('target_points', models.IntegerField(blank=True, help_text='Target points of the latest goal', null=True)),
+            ],
+        ),
+    ]
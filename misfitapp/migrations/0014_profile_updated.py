@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('misfitapp', '0013_usersnapshot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='updated',
+            field=models.DateTimeField(auto_now=True, blank=True, help_text='Datetime the profile was last imported from Misfit', null=True),
+        ),
+    ]
@@ -1,18 +1,44 @@
 from django.conf import settings
-from django.db import models, IntegrityError
+from django.core.cache import cache
+from django.db import connections, models, router, transaction, IntegrityError
+from django.db.models import Avg, Count, Q, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
+from collections import OrderedDict
+from functools import reduce
 from math import pow
 from misfit.notification import MisfitMessage
+from multiprocessing.pool import ThreadPool
+import arrow
 import datetime
+import operator
+import sqlite3
+import struct
+
+from . import defaults
 
 DAYS_IN_CHUNK = 30
 MAX_KEY_LEN = 24
 MISFIT_HISTORIC_TIMEDELTA = getattr(settings, 'MISFIT_HISTORIC_TIMEDELTA',
                                     datetime.timedelta(days=90))
+# The start of the historical import when the module was loaded. The
+# importers use historic_start_date() instead, which doesn't go stale in
+# long-running workers.
 HISTORIC_START_DATE = datetime.date.today() - MISFIT_HISTORIC_TIMEDELTA
 UserModel = getattr(settings, 'AUTH_USER_MODEL', 'auth.User')
 
 
+def historic_start_date():
+    """ The date from which historical data is imported, as of today """
+    return datetime.date.today() - MISFIT_HISTORIC_TIMEDELTA
+
+
+# A packed sleep segment: offset in seconds from the start and sleep type
+SLEEP_SEGMENT_STRUCT = struct.Struct('>iB')
+
+
 def chunkify_dates(start, end, days_in_chunk=DAYS_IN_CHUNK):
     """
     Return a list of tuples that chunks the date range into ranges
@@ -33,12 +59,247 @@ def chunkify_dates(start, end, days_in_chunk=DAYS_IN_CHUNK):
 def dedupe_by_field(l, field):
     """
     Returns a new list with duplicate objects removed. Objects are equal
-    iff the have the same value for 'field'.
+    iff the have the same value for 'field', or for every one of the fields
+    if 'field' is a tuple of field names.
     """
-    d = dict((getattr(obj, field), obj) for obj in l)
+    fields = field if isinstance(field, tuple) else (field,)
+    d = dict((tuple(getattr(obj, f) for f in fields), obj) for obj in l)
     return list(d.values())
 
 
+def encode_sleep_segments(start_time, segments):
+    """
+    Pack (time, sleep_type) pairs, ordered by time, into a compact binary
+    run-length encoding: each segment starts a run of its sleep type, and is
+    stored in five bytes as its offset in seconds from start_time and its type
+    """
+    return b''.join(
+        SLEEP_SEGMENT_STRUCT.pack(
+            int((time - start_time).total_seconds()), sleep_type)
+        for time, sleep_type in segments)
+
+
+def decode_sleep_segments(start_time, data):
+    """ The inverse of encode_sleep_segments """
+    data = bytes(data)
+    return [
+        (start_time + datetime.timedelta(seconds=offset), sleep_type)
+        for offset, sleep_type in (
+            SLEEP_SEGMENT_STRUCT.unpack_from(data, i)
+            for i in range(0, len(data), SLEEP_SEGMENT_STRUCT.size))]
+
+
+def supports_native_upsert(connection):
+    """
+    Returns True if the database behind connection understands
+    INSERT ... ON CONFLICT, i.e. PostgreSQL (9.5+) or SQLite 3.24+
+    """
+    if connection.vendor == 'postgresql':
+        return connection.pg_version >= 90500
+    if connection.vendor == 'sqlite':
+        return sqlite3.sqlite_version_info >= (3, 24, 0)
+    return False
+
+
+def bulk_upsert(model, objs, conflict_fields, update_fields=None):
+    """
+    Insert the (unsaved) model instances in objs, resolving rows that collide
+    on the unique conflict_fields. Colliding rows get update_fields copied
+    over from the new instance, or are left untouched if update_fields is
+    None. objs should already be deduped on conflict_fields. Uses a native
+    INSERT ... ON CONFLICT where the database supports
+    it, and falls back to bulk_create plus updates elsewhere.
+    """
+    if not objs:
+        return
+    connection = connections[router.db_for_write(model)]
+    conflict_fields = [model._meta.get_field(f) for f in conflict_fields]
+    if update_fields is not None:
+        update_fields = [model._meta.get_field(f) for f in update_fields]
+    with transaction.atomic(using=connection.alias):
+        if supports_native_upsert(connection):
+            _native_upsert(
+                connection, model, objs, conflict_fields, update_fields)
+        else:
+            _fallback_upsert(
+                connection, model, objs, conflict_fields, update_fields)
+
+
+def _native_upsert(connection, model, objs, conflict_fields, update_fields):
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_concrete_fields
+              if not isinstance(f, models.AutoField)]
+    if update_fields:
+        on_conflict = 'DO UPDATE SET %s' % ', '.join(
+            '%s = EXCLUDED.%s' % (qn(f.column), qn(f.column))
+            for f in update_fields)
+    else:
+        on_conflict = 'DO NOTHING'
+    sql = 'INSERT INTO %s (%s) VALUES %%s ON CONFLICT (%s) %s' % (
+        qn(model._meta.db_table),
+        ', '.join(qn(f.column) for f in fields),
+        ', '.join(qn(f.column) for f in conflict_fields),
+        on_conflict)
+    row_sql = '(%s)' % ', '.join(['%s'] * len(fields))
+    batch_size = max(connection.ops.bulk_batch_size(fields, objs), 1)
+    with connection.cursor() as cursor:
+        for i in range(0, len(objs), batch_size):
+            batch = objs[i:i + batch_size]
+            params = []
+            for obj in batch:
+                params.extend(
+                    f.get_db_prep_save(f.pre_save(obj, True), connection)
+                    for f in fields)
+            cursor.execute(
+                sql % ', '.join([row_sql] * len(batch)), params)
+
+
+def _fallback_upsert(connection, model, objs, conflict_fields, update_fields):
+    manager = model._default_manager.db_manager(connection.alias)
+    attnames = [f.attname for f in conflict_fields]
+
+    def key(obj):
+        return tuple(getattr(obj, a) for a in attnames)
+
+    lookup = reduce(operator.or_, (Q(**dict(zip(attnames, key(obj))))
+                                   for obj in objs))
+    existing = dict(
+        (tuple(row[1:]), row[0])
+        for row in manager.filter(lookup).values_list('pk', *attnames))
+    manager.bulk_create([obj for obj in objs if key(obj) not in existing])
+    if not update_fields:
+        return
+    to_update = []
+    for obj in objs:
+        if key(obj) in existing:
+            obj.pk = existing[key(obj)]
+            to_update.append(obj)
+    if hasattr(manager, 'bulk_update'):
+        manager.bulk_update(to_update, [f.name for f in update_fields])
+    else:
+        for obj in to_update:
+            manager.filter(pk=obj.pk).update(**dict(
+                (f.attname, getattr(obj, f.attname)) for f in update_fields))
+
+
+def day_start(date):
+    """ The datetime the date starts at, in the current time zone """
+    start = datetime.datetime.combine(date, datetime.time())
+    return timezone.make_aware(start) if settings.USE_TZ else start
+
+
+def local_date(dt):
+    """ The date of the datetime, in the current time zone """
+    return timezone.localtime(dt).date() if settings.USE_TZ else dt.date()
+
+
+def update_activity_data(uid, start_date, end_date):
+    """
+    Bring the user's ActivityRollups and DailyTimelines up to date, after
+    their Summary or Goal data in the date range has changed
+    """
+    ActivityRollup.update_for_dates(uid, start_date, end_date)
+    DailyTimeline.update_for_dates(uid, start_date, end_date)
+
+
+class UserDataQuerySet(models.QuerySet):
+    """ Filters shared by the querysets of per-user Misfit data """
+    date_field = 'date'
+
+    def for_user(self, user):
+        """ Only the data of the given user (or user id) """
+        return self.filter(user=user)
+
+    def between(self, start_date, end_date):
+        """
+        Only the data from start_date through end_date, inclusive. Days of
+        datetime fields start at midnight in the current time zone, like
+        those of DailyTimeline.
+        """
+        if self.date_field == 'date':
+            return self.filter(date__gte=start_date, date__lte=end_date)
+        return self.filter(**{
+            '%s__gte' % self.date_field: day_start(start_date),
+            '%s__lt' % self.date_field: day_start(
+                end_date + datetime.timedelta(days=1))
+        })
+
+
+class SummaryQuerySet(UserDataQuerySet):
+    def totals(self):
+        """
+        Returns a dict of the summed points, steps, calories,
+        activity_calories and distance, the number of days, and the average
+        daily steps, computed by the database
+        """
+        return self.aggregate(
+            points=Sum('points'), steps=Sum('steps'),
+            calories=Sum('calories'),
+            activity_calories=Sum('activity_calories'),
+            distance=Sum('distance'), days=Count('pk'),
+            average_steps=Avg('steps'))
+
+
+class SessionQuerySet(UserDataQuerySet):
+    date_field = 'start_time'
+
+    def by_activity_type(self):
+        """
+        Returns a dict per activity type, ordered by activity type, with the
+        number of sessions and their summed duration, points, steps, calories
+        and distance, computed by the database
+        """
+        return self.order_by('activity_type').values(
+            'activity_type').annotate(
+            sessions=Count('pk'), duration=Sum('duration'),
+            points=Sum('points'), steps=Sum('steps'),
+            calories=Sum('calories'), distance=Sum('distance'))
+
+
+class SleepQuerySet(UserDataQuerySet):
+    date_field = 'start_time'
+
+    def nightly_stage_totals(self):
+        """
+        Returns a dict per sleep, ordered by start time, with its id,
+        start_time, duration and the number of seconds spent awake, asleep and
+        in deep sleep. A segment lasts until the next one, or the end of the
+        sleep. The segments are read from the packed segments where possible,
+        so this takes a single query; sleeps without packed segments need one
+        more in total.
+        """
+        sleeps = list(self.order_by('start_time'))
+        rows = dict((sleep.pk, []) for sleep in sleeps
+                    if sleep.packed_segments is None)
+        if rows:
+            for sleep_id, time, sleep_type in SleepSegment.objects.filter(
+                    sleep_id__in=list(rows)).order_by('time').values_list(
+                        'sleep_id', 'time', 'sleep_type'):
+                rows[sleep_id].append((time, sleep_type))
+        stage_names = {SleepSegment.AWAKE: 'awake',
+                       SleepSegment.SLEEP: 'sleep',
+                       SleepSegment.DEEP_SLEEP: 'deep_sleep'}
+        nights = []
+        for sleep in sleeps:
+            night = {'id': sleep.pk, 'start_time': sleep.start_time,
+                     'duration': sleep.duration, 'awake': 0, 'sleep': 0,
+                     'deep_sleep': 0}
+            if sleep.packed_segments is None:
+                segments = rows[sleep.pk]
+            else:
+                segments = decode_sleep_segments(
+                    sleep.start_time, sleep.packed_segments)
+            end = sleep.start_time + datetime.timedelta(
+                seconds=sleep.duration)
+            ends = [time for time, _ in segments[1:]] + [end]
+            for (time, sleep_type), segment_end in zip(segments, ends):
+                if sleep_type in stage_names:
+                    night[stage_names[sleep_type]] += max(
+                        0, int((segment_end - time).total_seconds()))
+            nights.append(night)
+        return nights
+
+
 class MisfitModel(models.Model):
     class Meta:
         abstract = True
@@ -61,13 +322,160 @@ class MisfitModel(models.Model):
         raise NotImplementedError
 
     @classmethod
-    def import_all_from_misfit(cls, misfit, uid):
+    def import_all_from_misfit(cls, misfit, uid, progress=None):
         """
         This is used to import all data from misfit when a user is initially
         linked. By default it just runs import_from_misfit, but a model with
-        more complex needs can override this
+        more complex needs can override this. If an ImportProgress is given,
+        it is updated as data is imported.
+        """
+        result = cls.import_from_misfit(misfit, uid)
+        if progress is not None:
+            # import_from_misfit returns (obj, created), with a falsy obj if
+            # there was nothing to import (e.g. the user has no device)
+            progress.chunks_total = progress.chunks_done = 1
+            progress.rows = 1 if result and result[0] else 0
+            progress.save(
+                update_fields=['chunks_total', 'chunks_done', 'rows'])
+
+    @classmethod
+    def fetch_misfit_chunk(cls, misfit, start_date, end_date):
+        """
+        Derived classes that are imported by date range should implement this
+        to return the Misfit API objects for a single chunk
         """
-        cls.import_from_misfit(misfit, uid)
+        raise NotImplementedError
+
+    @classmethod
+    def save_misfit_chunk(cls, uid, objects, start_date, end_date,
+                          update=False):
+        """
+        Derived classes that are imported by date range should implement this
+        to write the Misfit API objects of a single chunk to the database,
+        returning the number of rows written
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def iter_misfit_chunks(cls, misfit, start_date, end_date):
+        """
+        Generator yielding (start, end, objects) for each chunk of the date
+        range, in order. Chunks are fetched lazily, up to
+        MISFIT_IMPORT_CONCURRENCY at a time, so at most that many are held in
+        memory. No more chunks are fetched at a time than the user has
+        requests remaining, if the client knows (see
+        RateLimitedMisfit.remaining_requests). As soon as one fetch fails
+        (e.g. the user's rate limit is reached), no further API calls are
+        made and the error is raised when its chunk comes up.
+        """
+        concurrency = getattr(settings, 'MISFIT_IMPORT_CONCURRENCY',
+                              defaults.MISFIT_IMPORT_CONCURRENCY)
+        date_chunks = chunkify_dates(start_date, end_date, DAYS_IN_CHUNK)
+        if concurrency <= 1:
+            for start, end in date_chunks:
+                yield start, end, cls.fetch_misfit_chunk(misfit, start, end)
+            return
+
+        errors = []
+
+        def fetch(start, end):
+            # Once any chunk has failed, stop calling out
+            if errors:
+                raise errors[0]
+            try:
+                return cls.fetch_misfit_chunk(misfit, start, end)
+            except Exception as e:
+                errors.append(e)
+                raise
+
+        remaining_requests = getattr(misfit, 'remaining_requests', None)
+        pool = ThreadPool(concurrency)
+        try:
+            i = 0
+            while i < len(date_chunks):
+                size = concurrency
+                remaining = remaining_requests and remaining_requests()
+                if remaining is not None:
+                    # Send at least one, to fail with the rate limit error
+                    size = max(1, min(size, remaining))
+                window = date_chunks[i:i + size]
+                i += size
+                results = [pool.apply_async(fetch, chunk) for chunk in window]
+                for (start, end), result in zip(window, results):
+                    yield start, end, result.get()
+        finally:
+            pool.terminate()
+
+    @classmethod
+    def import_misfit_chunks(cls, misfit, uid, start_date, end_date=None,
+                             update=False, sync_state=None, progress=None,
+                             update_until=None):
+        """
+        Stream the date range from Misfit, committing each chunk as soon as
+        it arrives. If a later chunk fails, earlier ones are already saved.
+        If a SyncState is given, its high-water date is checkpointed in the
+        same transaction as each chunk. Likewise, if an ImportProgress is
+        given, the chunks and rows done are counted. The end date defaults to
+        today. Chunks starting on or before update_until are saved as if
+        update were True.
+        """
+        if end_date is None:
+            end_date = datetime.date.today()
+        if progress is not None:
+            progress.chunks_total = progress.chunks_done + len(
+                chunkify_dates(start_date, end_date, DAYS_IN_CHUNK))
+            progress.save(update_fields=['chunks_total'])
+        for start, end, objects in cls.iter_misfit_chunks(
+                misfit, start_date, end_date):
+            chunk_update = update or (
+                update_until is not None and start <= update_until)
+            with transaction.atomic():
+                rows = cls.save_misfit_chunk(uid, objects, start, end,
+                                             update=chunk_update)
+                if sync_state is not None and (
+                        not sync_state.high_water_date or
+                        end > sync_state.high_water_date):
+                    sync_state.high_water_date = end
+                    sync_state.save(update_fields=['high_water_date'])
+                if progress is not None:
+                    progress.chunks_done += 1
+                    progress.rows += rows
+                    progress.save(update_fields=['chunks_done', 'rows'])
+
+    @classmethod
+    def sync_misfit_chunks(cls, misfit, uid, start_date=None, end_date=None,
+                           progress=None):
+        """
+        Like import_misfit_chunks, but only fetch what is newer than the
+        user's SyncState for this class. The state is advanced after every
+        chunk, so when the import is retried (e.g. after hitting the rate
+        limit) it resumes from the last completed chunk. The high-water day
+        is usually only partly imported, so its data is updated rather than
+        skipped. The dates default to historic_start_date() and today.
+        """
+        if start_date is None:
+            start_date = historic_start_date()
+        if end_date is None:
+            end_date = datetime.date.today()
+        state, _ = SyncState.objects.get_or_create(
+            user_id=uid, resource_type=cls.__name__)
+        update_until = None
+        if state.high_water_date and state.high_water_date >= start_date:
+            start_date = update_until = state.high_water_date
+        if update_until is not None and start_date >= end_date:
+            # Already synced up to the end date, e.g. when resyncing on the
+            # day of the last sync. Still refresh the high-water day, without
+            # moving the high-water date past it.
+            cls.import_misfit_chunks(
+                misfit, uid, start_date,
+                start_date + datetime.timedelta(days=1), update=True,
+                progress=progress)
+        else:
+            cls.import_misfit_chunks(misfit, uid, start_date, end_date,
+                                     sync_state=state, progress=progress,
+                                     update_until=update_until)
+        state.last_success = timezone.now()
+        state.save(update_fields=['last_success'])
 
 
 @python_2_unicode_compatible
@@ -90,6 +498,155 @@ class MisfitUser(models.Model):
         return self.user.get_username()
 
 
+# Cache key of a user's integration status, see utils.is_integrated
+INTEGRATION_CACHE_KEY = 'misfit-integrated-%s'
+
+
+@receiver([post_save, post_delete], sender=MisfitUser)
+def clear_integration_cache(sender, instance, **kwargs):
+    """ Forget the cached integration status of the Misfit user's user """
+    cache.delete(INTEGRATION_CACHE_KEY % instance.user_id)
+
+
+@python_2_unicode_compatible
+class UserSnapshot(models.Model):
+    """
+    The latest device, summary and goal state of a Misfit user, kept up to
+    date by the importers, so lists of users can be shown with a single join
+    """
+    misfit_user = models.OneToOneField(
+        MisfitUser,
+        primary_key=True,
+        related_name='snapshot',
+        help_text="The snapshot's Misfit user")
+    battery_level = models.SmallIntegerField(
+        null=True, blank=True,
+        help_text="Percentage battery remaining of the user's device")
+    last_sync_time = models.DateTimeField(
+        null=True, blank=True,
+        help_text="Datetime the user's device was last synced")
+    summary_date = models.DateField(
+        null=True, blank=True, help_text='The date of the latest summary')
+    steps = models.IntegerField(
+        null=True, blank=True, help_text='Steps of the latest summary')
+    points = models.FloatField(
+        null=True, blank=True, help_text='Points of the latest summary')
+    goal_date = models.DateField(
+        null=True, blank=True, help_text='The date of the latest goal')
+    goal_points = models.FloatField(
+        null=True, blank=True, help_text='Points of the latest goal')
+    target_points = models.IntegerField(
+        null=True, blank=True, help_text='Target points of the latest goal')
+
+    def __str__(self):
+        return '%s: %s' % (self.misfit_user_id, self.summary_date)
+
+    def goal_percent_complete(self):
+        """
+        The percentage of the latest goal's target points reached, or None if
+        there is no target
+        """
+        if not self.target_points or self.goal_points is None:
+            return None
+        return float(self.goal_points) / self.target_points * 100
+
+    @classmethod
+    def update_for_user(cls, uid, **data):
+        """ Set the given fields of the snapshots of the user """
+        bulk_upsert(cls, [
+            cls(misfit_user_id=pk, **data) for pk in
+            MisfitUser.objects.filter(user_id=uid).values_list(
+                'pk', flat=True)
+        ], ('misfit_user',), update_fields=list(data))
+
+
+@python_2_unicode_compatible
+class SyncState(models.Model):
+    """
+    How far a user's data of one resource type has been imported from Misfit,
+    so later imports only need to fetch what is new
+    """
+    RESOURCE_TYPES = (('Summary', 'Summary'),
+                      ('Goal', 'Goal'),
+                      ('Session', 'Session'),
+                      ('Sleep', 'Sleep'))
+
+    user = models.ForeignKey(UserModel, help_text="The sync state's user")
+    resource_type = models.CharField(
+        choices=RESOURCE_TYPES,
+        max_length=15,
+        help_text='The type of data being synced, one of: {}'.format(
+            ', '.join([c for c, _ in RESOURCE_TYPES])
+        ))
+    high_water_date = models.DateField(
+        null=True,
+        blank=True,
+        help_text='Date up to which data has been imported')
+    last_success = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text='Datetime of the last successful import')
+
+    def __str__(self):
+        return '%s %s: %s' % (self.user_id, self.resource_type,
+                              self.high_water_date)
+
+    class Meta:
+        unique_together = ('user', 'resource_type')
+
+
+@python_2_unicode_compatible
+class ImportProgress(models.Model):
+    """
+    The progress of a user's historical import of one resource type, so it
+    can be displayed without counting the imported data
+    """
+    RESOURCE_TYPES = (('Profile', 'Profile'),
+                      ('Device', 'Device'),
+                      ('Summary', 'Summary'),
+                      ('Goal', 'Goal'),
+                      ('Session', 'Session'),
+                      ('Sleep', 'Sleep'))
+
+    user = models.ForeignKey(UserModel, help_text="The import's user")
+    resource_type = models.CharField(
+        choices=RESOURCE_TYPES,
+        max_length=15,
+        help_text='The type of data being imported, one of: {}'.format(
+            ', '.join([c for c, _ in RESOURCE_TYPES])
+        ))
+    chunks_done = models.IntegerField(
+        default=0, help_text='Number of chunks imported so far')
+    chunks_total = models.IntegerField(
+        default=0, help_text='Number of chunks to import')
+    rows = models.IntegerField(
+        default=0, help_text='Number of objects imported so far')
+    started = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text='Datetime when the import started')
+    finished = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text='Datetime when the import finished')
+    failed = models.BooleanField(
+        default=False, help_text='Whether the import finished with an error')
+
+    def __str__(self):
+        return '%s %s: %s/%s' % (self.user_id, self.resource_type,
+                                 self.chunks_done, self.chunks_total)
+
+    @property
+    def duration(self):
+        """ The timedelta the import took, or None if it hasn't finished """
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    class Meta:
+        unique_together = ('user', 'resource_type')
+
+
 @python_2_unicode_compatible
 class Summary(MisfitModel):
     """
@@ -106,6 +663,11 @@ class Summary(MisfitModel):
     distance = models.FloatField(
         help_text='Distance traveled during the day, in miles')
 
+    objects = SummaryQuerySet.as_manager()
+
+    UPDATE_FIELDS = ('points', 'steps', 'calories', 'activity_calories',
+                     'distance')
+
     def __str__(self):
         return '%s: %s' % (self.date.strftime('%Y-%m-%d'), self.steps)
 
@@ -113,39 +675,66 @@ class Summary(MisfitModel):
         unique_together = ('user', 'date')
 
     @classmethod
-    def import_from_misfit(cls, misfit, uid, update=False,
-                           start_date=HISTORIC_START_DATE,
-                           end_date=datetime.date.today()):
+    def import_from_misfit(cls, misfit, uid, update=False, start_date=None,
+                           end_date=None):
         """
         Imports all Summary data from misfit for the specified date range,
         chunking API calls if needed. If update is True, update existing
-        records
+        records. The dates default to historic_start_date() and today.
         """
+        if start_date is None:
+            start_date = historic_start_date()
+        cls.import_misfit_chunks(
+            misfit, uid, start_date, end_date, update=update)
+        cls.update_snapshot(uid)
+
+    @classmethod
+    def import_all_from_misfit(cls, misfit, uid,
+                               start_date=None, end_date=None, progress=None):
+        cls.sync_misfit_chunks(misfit, uid, start_date, end_date,
+                               progress=progress)
+        cls.update_snapshot(uid)
+
+    @classmethod
+    def update_snapshot(cls, uid):
+        """ Copy the user's latest summary to their UserSnapshot """
+        latest = cls.objects.filter(user_id=uid).order_by('-date').values(
+            'date', 'steps', 'points').first()
+        if latest is not None:
+            UserSnapshot.update_for_user(
+                uid, summary_date=latest['date'], steps=latest['steps'],
+                points=latest['points'])
+
+    @classmethod
+    def fetch_misfit_chunk(cls, misfit, start_date, end_date):
+        return misfit.summary(
+            start_date=start_date, end_date=end_date, detail=True)
+
+    @classmethod
+    def save_misfit_chunk(cls, uid, summaries, start_date, end_date,
+                          update=False):
         # Keep track of the data we already have
-        exists = cls.objects.filter(
+        exists = set(cls.objects.filter(
             user_id=uid, date__gte=start_date, date__lte=end_date
-        ).values_list('date', flat=True)
-        date_chunks = chunkify_dates(start_date, end_date, 30)
+        ).values_list('date', flat=True))
         obj_list = []
-        for start, end in date_chunks:
-            summaries = misfit.summary(
-                start_date=start, end_date=end, detail=True)
-            for summary in summaries:
-                if update or summary.date.date() not in exists:
-                    data = {
-                        'date': summary.date.date(),
-                        'points': summary.points,
-                        'steps': summary.steps,
-                        'calories': summary.calories,
-                        'activity_calories': summary.activityCalories,
-                        'distance': summary.distance
-                    }
-                    if update:
-                        cls.objects.update_or_create(
-                            user_id=uid, date=data['date'], defaults=data)
-                    else:
-                        obj_list.append(cls(user_id=uid, **data))
-        cls.objects.bulk_create(dedupe_by_field(obj_list, 'date'))
+        for summary in summaries:
+            if update or summary.date.date() not in exists:
+                data = {
+                    'date': summary.date.date(),
+                    'points': summary.points,
+                    'steps': summary.steps,
+                    'calories': summary.calories,
+                    'activity_calories': summary.activityCalories,
+                    'distance': summary.distance
+                }
+                obj_list.append(cls(user_id=uid, **data))
+        obj_list = dedupe_by_field(obj_list, 'date')
+        bulk_upsert(cls, obj_list, ('user', 'date'),
+                    update_fields=cls.UPDATE_FIELDS if update else None)
+        if obj_list:
+            update_activity_data(uid, start_date, end_date)
+        return len(obj_list)
 
 
 @python_2_unicode_compatible
@@ -172,6 +761,11 @@ class Profile(MisfitModel):
         null=True, blank=True, help_text='The name on the profile')
     avatar = models.URLField(
         null=True, blank=True, help_text="URL to the profile's avatar")
+    updated = models.DateTimeField(
+        auto_now=True,
+        null=True,
+        blank=True,
+        help_text='Datetime the profile was last imported from Misfit')
 
     def __str__(self):
         return self.email
@@ -233,7 +827,12 @@ class Device(MisfitModel):
         # Check for the undocumented lastSyncTime data
         if hasattr(device, 'lastSyncTime') and device.lastSyncTime:
             data['last_sync_time'] = device.lastSyncTime.datetime
-        return cls.objects.update_or_create(user_id=uid, defaults=data)
+        device, created = cls.objects.update_or_create(
+            user_id=uid, defaults=data)
+        UserSnapshot.update_for_user(
+            uid, battery_level=device.battery_level,
+            last_sync_time=device.last_sync_time)
+        return device, created
 
 
 @python_2_unicode_compatible
@@ -254,10 +853,16 @@ class Goal(MisfitModel):
     time_zone_offset = models.SmallIntegerField(
         default=0, help_text='Timezone offset from UTC')
 
+    UPDATE_FIELDS = ('date', 'points', 'target_points')
+
     def __str__(self):
         return '%s %s %s of %s' % (self.id, self.date, self.points,
                                    self.target_points)
 
+    class Meta:
+        # Covers the importers' existence scans, so they only read the index
+        index_together = [('user', 'date', 'id')]
+
     @classmethod
     def data_dict(cls, obj):
         result = {
@@ -278,29 +883,230 @@ class Goal(MisfitModel):
         if not hasattr(obj, 'id'):
             return False, False
         data = cls.data_dict(obj)
-        return cls.objects.update_or_create(
+        goal, created = cls.objects.update_or_create(
             user_id=uid, id=data['id'], defaults=data)
+        update_activity_data(uid, goal.date, goal.date)
+        cls.update_snapshot(uid)
+        return goal, created
+
+    @classmethod
+    def update_snapshot(cls, uid):
+        """ Copy the user's latest goal to their UserSnapshot """
+        latest = cls.objects.filter(user_id=uid).order_by('-date').values(
+            'date', 'points', 'target_points').first()
+        if latest is not None:
+            UserSnapshot.update_for_user(
+                uid, goal_date=latest['date'], goal_points=latest['points'],
+                target_points=latest['target_points'])
+
+    @classmethod
+    def process_message(cls, message, misfit, uid):
+        if message.action != MisfitMessage.DELETED:
+            return super(Goal, cls).process_message(message, misfit, uid)
+        # Keep the rollups and timelines of deleted goals up to date
+        dates = list(cls.objects.filter(pk=message.id).values_list(
+            'date', flat=True))
+        result = super(Goal, cls).process_message(message, misfit, uid)
+        for date in dates:
+            update_activity_data(uid, date, date)
+        return result
 
     @classmethod
     def import_all_from_misfit(cls, misfit, uid,
-                               start_date=HISTORIC_START_DATE,
-                               end_date=datetime.date.today()):
+                               start_date=None, end_date=None, progress=None):
+        cls.sync_misfit_chunks(misfit, uid, start_date, end_date,
+                               progress=progress)
+        cls.update_snapshot(uid)
+
+    @classmethod
+    def fetch_misfit_chunk(cls, misfit, start_date, end_date):
+        return misfit.goal(start_date=start_date, end_date=end_date)
+
+    @classmethod
+    def save_misfit_chunk(cls, uid, goals, start_date, end_date,
+                          update=False):
         # Keep track of the data we already have
-        exists = cls.objects.filter(
+        exists = set(cls.objects.filter(
             user_id=uid, date__gte=start_date, date__lte=end_date
-        ).values_list('id', flat=True)
+        ).values_list('id', flat=True))
         obj_list = []
-        date_chunks = chunkify_dates(start_date, end_date, 30)
-        for start, end in date_chunks:
-            goals = misfit.goal(start_date=start, end_date=end)
-            for goal in goals:
-                if not hasattr(goal, 'id'):
-                    # For some reason, goals occasionally have no id, ignore
-                    continue
-                if goal.id not in exists:
-                    model_data = cls.data_dict(goal)
-                    obj_list.append(cls(user_id=uid, **model_data))
-        cls.objects.bulk_create(dedupe_by_field(obj_list, 'id'))
+        for goal in goals:
+            if not hasattr(goal, 'id'):
+                # For some reason, goals occasionally have no id, ignore
+                continue
+            if update or goal.id not in exists:
+                model_data = cls.data_dict(goal)
+                obj_list.append(cls(user_id=uid, **model_data))
+        obj_list = dedupe_by_field(obj_list, 'id')
+        bulk_upsert(cls, obj_list, ('id',),
+                    update_fields=cls.UPDATE_FIELDS if update else None)
+        if obj_list:
+            update_activity_data(uid, start_date, end_date)
+        return len(obj_list)
+
+
+@python_2_unicode_compatible
+class ActivityRollup(models.Model):
+    """
+    A user's Summary and Goal totals for a week (starting on Monday) or a
+    calendar month. The importers keep these up to date as data comes in.
+    """
+    WEEK = 'week'
+    MONTH = 'month'
+    PERIODS = ((WEEK, 'week'),
+               (MONTH, 'month'))
+
+    user = models.ForeignKey(UserModel, help_text="The rollup's user")
+    period = models.CharField(
+        choices=PERIODS,
+        max_length=5,
+        help_text='The length of the period, one of: {}'.format(
+            ', '.join([c for c, _ in PERIODS])
+        ))
+    period_start = models.DateField(help_text='The first day of the period')
+    points = models.FloatField(default=0, help_text='Total points')
+    steps = models.BigIntegerField(default=0, help_text='Total steps')
+    calories = models.FloatField(default=0, help_text='Total calories')
+    activity_calories = models.FloatField(
+        default=0, help_text='Total activity calories')
+    distance = models.FloatField(
+        default=0, help_text='Total distance traveled, in miles')
+    days = models.IntegerField(
+        default=0, help_text='Number of days with a summary')
+    goals = models.IntegerField(default=0, help_text='Number of goals')
+    goals_met = models.IntegerField(
+        default=0, help_text='Number of goals whose target points were met')
+
+    UPDATE_FIELDS = ('points', 'steps', 'calories', 'activity_calories',
+                     'distance', 'days', 'goals', 'goals_met')
+
+    def __str__(self):
+        return '%s %s %s: %s' % (self.user_id, self.period,
+                                 self.period_start, self.steps)
+
+    class Meta:
+        unique_together = ('user', 'period', 'period_start')
+
+    @classmethod
+    def periods(cls, date):
+        """ Returns the (period, period_start) keys date is rolled up in """
+        return ((cls.WEEK, date - datetime.timedelta(days=date.weekday())),
+                (cls.MONTH, date.replace(day=1)))
+
+    @classmethod
+    def update_for_dates(cls, uid, start_date, end_date):
+        """
+        Recalculate the user's rollups of every period that overlaps the date
+        range, from the Summary and Goal data of just those periods
+        """
+        keys = set()
+        date = start_date
+        while date <= end_date:
+            keys.update(cls.periods(date))
+            date += datetime.timedelta(days=1)
+        rollups = dict(
+            (key, cls(user_id=uid, period=key[0], period_start=key[1]))
+            for key in keys)
+        # The periods are contiguous, so read the data in a single range
+        first = min(period_start for _, period_start in keys)
+        last = max(end_date + datetime.timedelta(days=6 - end_date.weekday()),
+                   (end_date.replace(day=28) + datetime.timedelta(days=4)
+                    ).replace(day=1) - datetime.timedelta(days=1))
+        for row in Summary.objects.filter(
+                user_id=uid, date__gte=first, date__lte=last).values_list(
+                    'date', 'points', 'steps', 'calories',
+                    'activity_calories', 'distance'):
+            for key in cls.periods(row[0]):
+                rollup = rollups.get(key)
+                if rollup is not None:
+                    rollup.points += row[1]
+                    rollup.steps += row[2]
+                    rollup.calories += row[3]
+                    rollup.activity_calories += row[4]
+                    rollup.distance += row[5]
+                    rollup.days += 1
+        for date, points, target_points in Goal.objects.filter(
+                user_id=uid, date__gte=first, date__lte=last).values_list(
+                    'date', 'points', 'target_points'):
+            for key in cls.periods(date):
+                rollup = rollups.get(key)
+                if rollup is not None:
+                    rollup.goals += 1
+                    if target_points and points >= target_points:
+                        rollup.goals_met += 1
+        bulk_upsert(cls, list(rollups.values()),
+                    ('user', 'period', 'period_start'),
+                    update_fields=cls.UPDATE_FIELDS)
+
+
+@python_2_unicode_compatible
+class DailyTimeline(models.Model):
+    """
+    A user's activity, goal and sleep for a day, denormalized from Summary,
+    Goal and Sleep so a timeline can be read with a single range query. The
+    importers keep these up to date as data comes in. Sleeps count towards
+    the day they end on, in the current time zone.
+    """
+    user = models.ForeignKey(UserModel, help_text="The timeline's user")
+    date = models.DateField(help_text='The date of the timeline entry')
+    steps = models.IntegerField(
+        null=True, blank=True, help_text="Steps for the day, from Summary")
+    points = models.FloatField(
+        null=True, blank=True, help_text="Points for the day, from Summary")
+    target_points = models.IntegerField(
+        null=True, blank=True,
+        help_text="Target points for the day, from Goal")
+    sleep_duration = models.IntegerField(
+        default=0, help_text='Seconds asleep, including deep sleep')
+    deep_sleep_duration = models.IntegerField(
+        default=0, help_text='Seconds in deep sleep')
+
+    UPDATE_FIELDS = ('steps', 'points', 'target_points', 'sleep_duration',
+                     'deep_sleep_duration')
+
+    def __str__(self):
+        return '%s %s: %s' % (self.user_id, self.date, self.steps)
+
+    class Meta:
+        unique_together = ('user', 'date')
+
+    @classmethod
+    def update_for_dates(cls, uid, start_date, end_date):
+        """
+        Recalculate the user's timeline from start_date through end_date
+        from their Summary, Goal and Sleep data
+        """
+        timelines = {}
+        date = start_date
+        while date <= end_date:
+            timelines[date] = cls(user_id=uid, date=date)
+            date += datetime.timedelta(days=1)
+        for date, steps, points in Summary.objects.filter(
+                user_id=uid, date__gte=start_date, date__lte=end_date
+        ).values_list('date', 'steps', 'points'):
+            timelines[date].steps = steps
+            timelines[date].points = points
+        for date, target_points in Goal.objects.filter(
+                user_id=uid, date__gte=start_date, date__lte=end_date
+        ).values_list('date', 'target_points'):
+            timelines[date].target_points = target_points
+        # Sleeps that end in the range started at most a day earlier
+        for night in Sleep.objects.filter(
+                user_id=uid,
+                start_time__gte=day_start(
+                    start_date - datetime.timedelta(days=1)),
+                start_time__lt=day_start(
+                    end_date + datetime.timedelta(days=1))
+        ).nightly_stage_totals():
+            timeline = timelines.get(local_date(
+                night['start_time'] +
+                datetime.timedelta(seconds=night['duration'])))
+            if timeline is not None:
+                timeline.sleep_duration += (
+                    night['sleep'] + night['deep_sleep'])
+                timeline.deep_sleep_duration += night['deep_sleep']
+        bulk_upsert(cls, list(timelines.values()), ('user', 'date'),
+                    update_fields=cls.UPDATE_FIELDS)
 
 
 @python_2_unicode_compatible
@@ -340,10 +1146,19 @@ class Session(MisfitModel):
         null=True,
         help_text='Total distance user covered for the activity, in miles')
 
+    objects = SessionQuerySet.as_manager()
+
+    UPDATE_FIELDS = ('activity_type', 'start_time', 'duration', 'points',
+                     'steps', 'calories', 'distance')
+
     def __str__(self):
         return '%s %s %s' % (self.start_time, self.duration,
                              self.activity_type)
 
+    class Meta:
+        # Covers the importers' existence scans, so they only read the index
+        index_together = [('user', 'start_time', 'id')]
+
     @classmethod
     def data_dict(cls, obj):
         return {
@@ -365,23 +1180,32 @@ class Session(MisfitModel):
 
     @classmethod
     def import_all_from_misfit(cls, misfit, uid,
-                               start_date=HISTORIC_START_DATE,
-                               end_date=datetime.date.today()):
+                               start_date=None, end_date=None, progress=None):
+        cls.sync_misfit_chunks(misfit, uid, start_date, end_date,
+                               progress=progress)
+
+    @classmethod
+    def fetch_misfit_chunk(cls, misfit, start_date, end_date):
+        return misfit.session(start_date=start_date, end_date=end_date)
+
+    @classmethod
+    def save_misfit_chunk(cls, uid, sessions, start_date, end_date,
+                          update=False):
         # Keep track of the data we already have
-        exists = cls.objects.filter(
+        exists = set(cls.objects.filter(
             user_id=uid,
             start_time__gte=start_date,
             start_time__lt=end_date + datetime.timedelta(days=1)
-        ).values_list('id', flat=True)
+        ).values_list('id', flat=True))
         obj_list = []
-        date_chunks = chunkify_dates(start_date, end_date, 30)
-        for start, end in date_chunks:
-            sessions = misfit.session(start_date=start, end_date=end)
-            for session in sessions:
-                if session.id not in exists:
-                    model_data = cls.data_dict(session)
-                    obj_list.append(cls(user_id=uid, **model_data))
-        cls.objects.bulk_create(dedupe_by_field(obj_list, 'id'))
+        for session in sessions:
+            if update or session.id not in exists:
+                model_data = cls.data_dict(session)
+                obj_list.append(cls(user_id=uid, **model_data))
+        obj_list = dedupe_by_field(obj_list, 'id')
+        bulk_upsert(cls, obj_list, ('id',),
+                    update_fields=cls.UPDATE_FIELDS if update else None)
+        return len(obj_list)
 
 
 @python_2_unicode_compatible
@@ -401,10 +1225,23 @@ class Sleep(MisfitModel):
         help_text='Datetime the sleep session started')
     duration = models.IntegerField(
         help_text='Duration of the sleep session, in seconds')
+    packed_segments = models.BinaryField(
+        null=True,
+        blank=True,
+        help_text='The sleep segments, packed by encode_sleep_segments')
+
+    objects = SleepQuerySet.as_manager()
+
+    UPDATE_FIELDS = ('auto_detected', 'start_time', 'duration',
+                     'packed_segments')
 
     def __str__(self):
         return '%s %s' % (self.start_time, self.duration)
 
+    class Meta:
+        # Covers reading a user's sleeps by date range from the index
+        index_together = [('user', 'start_time', 'id')]
+
     @classmethod
     def data_dict(cls, obj):
         return {
@@ -414,23 +1251,74 @@ class Sleep(MisfitModel):
             'duration': obj.duration
         }
 
+    def get_segments(self):
+        """
+        Returns the sleep's segments as SleepSegment objects, ordered by time.
+        If the segments are packed, no queries are needed.
+        """
+        if self.packed_segments is None:
+            return list(self.sleepsegment_set.order_by('time'))
+        return [SleepSegment(sleep=self, time=time, sleep_type=sleep_type)
+                for time, sleep_type in decode_sleep_segments(
+                    self.start_time, self.packed_segments)]
+
     @classmethod
     def import_misfit_sleeps(cls, misfit, uid, sleeps):
-        segments = {}
+        """
+        Save the given Misfit sleeps with their packed segments, and replace
+        their SleepSegment rows (unless MISFIT_SLEEP_SEGMENT_ROWS is False),
+        in a fixed number of queries regardless of how many sleeps there are.
+        Returns the number of sleeps saved.
+        """
+        sleep_list = []
+        seg_list = []
         for misfit_sleep in sleeps:
             data = cls.data_dict(misfit_sleep)
-            sleep, created = cls.objects.update_or_create(
-                id=data['id'], user_id=uid, defaults=data)
-            segments[sleep.id] = misfit_sleep.data['sleepDetails']
-            if not created:
-                SleepSegment.objects.filter(sleep=sleep).delete()
-        seg_list = []
-        for sleep_id, segments in segments.items():
-            for segment in segments:
-                seg_list.append(SleepSegment(sleep_id=sleep_id,
-                                             time=segment['datetime'],
-                                             sleep_type=segment['value']))
-        SleepSegment.objects.bulk_create(dedupe_by_field(seg_list, 'time'))
+            segments = OrderedDict(sorted(
+                (arrow.get(segment['datetime']).datetime, segment['value'])
+                for segment in misfit_sleep.data['sleepDetails']))
+            data['packed_segments'] = encode_sleep_segments(
+                data['start_time'], segments.items())
+            sleep_list.append(cls(user_id=uid, **data))
+            for time, sleep_type in segments.items():
+                seg_list.append(SleepSegment(sleep_id=data['id'], time=time,
+                                             sleep_type=sleep_type))
+        sleep_list = dedupe_by_field(sleep_list, 'id')
+        with transaction.atomic():
+            bulk_upsert(cls, sleep_list, ('id',),
+                        update_fields=cls.UPDATE_FIELDS)
+            SleepSegment.objects.filter(
+                sleep_id__in=[sleep.id for sleep in sleep_list]).delete()
+            if getattr(settings, 'MISFIT_SLEEP_SEGMENT_ROWS',
+                       defaults.MISFIT_SLEEP_SEGMENT_ROWS):
+                SleepSegment.objects.bulk_create(
+                    dedupe_by_field(seg_list, ('sleep_id', 'time')))
+            if sleep_list:
+                cls.update_timelines(uid, [sleep.start_time
+                                           for sleep in sleep_list])
+        return len(sleep_list)
+
+    @classmethod
+    def update_timelines(cls, uid, start_times):
+        """
+        Update the user's DailyTimelines for the days sleeps starting at
+        start_times may end on
+        """
+        DailyTimeline.update_for_dates(
+            uid, local_date(min(start_times)),
+            local_date(max(start_times)) + datetime.timedelta(days=1))
+
+    @classmethod
+    def process_message(cls, message, misfit, uid):
+        if message.action != MisfitMessage.DELETED:
+            return super(Sleep, cls).process_message(message, misfit, uid)
+        # Keep the timelines of deleted sleeps up to date
+        start_times = list(cls.objects.filter(pk=message.id).values_list(
+            'start_time', flat=True))
+        result = super(Sleep, cls).process_message(message, misfit, uid)
+        if start_times:
+            cls.update_timelines(uid, start_times)
+        return result
 
     @classmethod
     def import_from_misfit(cls, misfit, uid, object_id=None):
@@ -439,12 +1327,18 @@ class Sleep(MisfitModel):
 
     @classmethod
     def import_all_from_misfit(cls, misfit, uid,
-                               start_date=HISTORIC_START_DATE,
-                               end_date=datetime.date.today()):
-        sleeps = []
-        for start, end in chunkify_dates(start_date, end_date, 30):
-            sleeps += misfit.sleep(start_date=start, end_date=end)
-        cls.import_misfit_sleeps(misfit, uid, sleeps)
+                               start_date=None, end_date=None, progress=None):
+        cls.sync_misfit_chunks(misfit, uid, start_date, end_date,
+                               progress=progress)
+
+    @classmethod
+    def fetch_misfit_chunk(cls, misfit, start_date, end_date):
+        return misfit.sleep(start_date=start_date, end_date=end_date)
+
+    @classmethod
+    def save_misfit_chunk(cls, uid, sleeps, start_date, end_date,
+                          update=False):
+        return cls.import_misfit_sleeps(None, uid, sleeps)
 
 
 @python_2_unicode_compatible
@@ -0,0 +1,6 @@
+from django.dispatch import Signal
+
+
+# Sent when every resource type of a user's historical import has finished,
+# see ImportProgress
+historical_import_complete = Signal(providing_args=['user_id'])
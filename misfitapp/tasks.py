@@ -1,84 +1,147 @@
 import arrow
+import hashlib
 import logging
 import sys
+import time
 
-from celery import shared_task
-from celery.exceptions import Reject
+from celery import group, shared_task, Task
+from celery.exceptions import Reject, Retry
+from collections import OrderedDict
 from cryptography.exceptions import InvalidSignature
 from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
 from datetime import timedelta, date
 from misfit.exceptions import MisfitBadRequest, MisfitRateLimitError
-from misfit.notification import MisfitNotification
+from misfit.notification import MisfitMessage
 
-from . import models, utils
+from . import models, signals, utils
 
 logger = logging.getLogger(__name__)
 
+# The models whose historical data is imported, by name
+HISTORICAL_RESOURCE_TYPES = (
+    'Profile', 'Device', 'Summary', 'Goal', 'Session', 'Sleep')
 
-def misfit_retry_exc(task_func, exc):
+
+def misfit_retry_exc(task_func, exc, **kwargs):
     # We have hit the rate limit for the user, retry when it's reset,
     # according to the header in the reply from the failing API call
     reset = arrow.get(exc.response.headers['x-ratelimit-reset'])
     secs = (reset - arrow.now()).seconds
     logger.debug('Rate limit reached, will try again in %i seconds' % secs)
-    return task_func.retry(countdown=secs)
+    return task_func.retry(countdown=secs, **kwargs)
 
 
-@shared_task
-def import_historical(misfit_user):
+class LaneTask(Task):
     """
-    Import a user's historical data from Misfit starting at start_date.
-    Spin off a new task for each data type. If there is existing data,
-    it is not overwritten.
+    A task that belongs to one of the lanes configured in MISFIT_TASK_LANES,
+    whose options (e.g. queue and priority) it is sent with by default. This
+    keeps live notification processing from waiting behind backfills.
     """
-    for cls in ('Profile', 'Device', 'Summary', 'Goal', 'Session', 'Sleep',):
-        import_historical_cls.delay(getattr(models, cls), misfit_user)
+    abstract = True
+    lane = None
 
+    def apply_async(self, args=None, kwargs=None, **options):
+        lane_options = utils.get_setting('MISFIT_TASK_LANES').get(self.lane)
+        for name, value in (lane_options or {}).items():
+            options.setdefault(name, value)
+        return super(LaneTask, self).apply_async(args, kwargs, **options)
 
-@shared_task
-def import_historical_cls(cls, misfit_user):
-    try:
-        misfit = utils.create_misfit(access_token=misfit_user.access_token)
-        cls.import_all_from_misfit(misfit, misfit_user.user_id)
-    except MisfitRateLimitError:
-        raise misfit_retry_exc(import_historical_cls, sys.exc_info()[1])
-    except Exception:
-        exc = sys.exc_info()[1]
-        logger.exception("Unknown exception importing data: %s" % exc)
-        raise Reject(exc, requeue=False)
 
+def buffer_key(owner_id, message_type):
+    return 'misfit-notification-buffer-%s-%s' % (owner_id, message_type)
 
-@shared_task
-def process_notification(content):
-    """ Process a Misfit notification """
 
-    try:
-        notification = MisfitNotification(content)
-    except InvalidSignature:
-        logger.exception('Invalid message signature')
-        raise Reject('Invalid message signature', requeue=False)
+def buffer_messages(messages, window):
+    """
+    Add messages to the shared per-owner, per-type buffers in the Django
+    cache, keeping only the latest message for each object id. The first
+    message in a buffer schedules it to be processed window seconds later,
+    so a burst of messages for the same objects is only processed once.
+    """
+    buffers = {}
+    for message in messages:
+        buffers.setdefault((message.ownerId, message.type), []).append(message)
+    for (owner_id, message_type), new_messages in buffers.items():
+        key = buffer_key(owner_id, message_type)
+        with utils.cache_lock(key):
+            buffered = cache.get(key) or {}
+            due = cache.get('%s-due' % key)
+            # Schedule processing unless it already is. If it is long
+            # overdue, its task may have been lost, so schedule it again: an
+            # extra task just finds the buffer empty.
+            schedule = due is None or due + window * 10 < time.time()
+            for message in new_messages:
+                previous = buffered.get(message.id)
+                if (previous is None or arrow.get(previous['updatedAt']) <=
+                        message.updatedAt):
+                    buffered[message.id] = message.data
+            # Never expire the buffer, however late the worker processing it
+            # is, or the messages would be lost
+            cache.set(key, buffered, None)
+            if schedule:
+                cache.set('%s-due' % key, time.time() + window, None)
+        if schedule:
+            process_buffered_messages.apply_async(
+                args=(owner_id, message_type), countdown=window)
 
-    if notification.Type == 'SubscriptionConfirmation':
-        # If the message is a subscription confirmation, then we are already
-        # finished.
-        return
 
-    # For safety (so the queue doesn't crash) wrap all this in a big try/catch
+def pop_buffered_messages(owner_id, message_type):
+    """ Empty an owner's buffer for message_type, returning its messages """
+    key = buffer_key(owner_id, message_type)
+    with utils.cache_lock(key):
+        buffered = cache.get(key) or {}
+        cache.delete_many([key, '%s-due' % key])
+    return list(buffered.values())
+
+
+def message_key(message):
+    """
+    The cache key recording that a message has been processed. SNS may
+    deliver a message more than once, and Misfit may resend it, but a
+    message for the same object, action and update time is only processed
+    once.
+    """
+    return 'misfit-message-%s' % hashlib.sha1('|'.join([
+        message.ownerId, message.type, message.id, message.action,
+        message.data.get('updatedAt', '')]).encode('utf8')).hexdigest()
+
+
+def process_messages(task_func, messages, **retry_kwargs):
+    """
+    Import the data referred to by a list of MisfitMessages, in order,
+    skipping the ones that have already been processed. If the rate limit is
+    reached, task_func is retried with retry_kwargs.
+    """
+    keys = OrderedDict((message_key(message), message)
+                       for message in messages)
+    processed = cache.get_many(list(keys.keys()))
+    messages = [(key, message) for key, message in keys.items()
+                if key not in processed]
+    imported = []
+    summaries = {}
+    # Look up every owner at once, and only create one Misfit client per owner
+    mfusers = models.MisfitUser.objects.in_bulk(
+        set(message.ownerId for _, message in messages))
+    misfits = {}
     try:
-        summaries = {}
-        for message in notification.Message:
+        for key, message in messages:
             ownerId = message.ownerId
-            try:
-                mfuser = models.MisfitUser.objects.get(misfit_user_id=ownerId)
-            except models.MisfitUser.DoesNotExist:
-                logger.warning('Received a notification for a user who is not '
-                               'in our database with id: %s' % ownerId)
+            mfuser = mfusers.get(ownerId)
+            if mfuser is None:
+                logger.warning('Received a notification for a user who is '
+                               'not in our database with id: %s' % ownerId)
                 continue
-            misfit = utils.create_misfit(access_token=mfuser.access_token)
+            if ownerId not in misfits:
+                misfits[ownerId] = utils.create_misfit(
+                    access_token=mfuser.access_token)
+            misfit = misfits[ownerId]
 
             uid = mfuser.user_id
             try:
-                # Try to get the appropriate Misfit model based on message type
+                # Try to get the appropriate Misfit model based on message
+                # type
                 misfit_class = getattr(models, message.type.capitalize()[0:-1])
                 # Run the class's processing on the message
                 obj, _ = misfit_class.process_message(message, misfit, uid)
@@ -91,13 +154,15 @@ def process_notification(content):
                         message.type, message.id)
                 )
             except MisfitRateLimitError:
-                raise misfit_retry_exc(process_notification, sys.exc_info()[1])
+                raise misfit_retry_exc(
+                    task_func, sys.exc_info()[1], **retry_kwargs)
             except Exception:
                 logger.exception(
                     'Generic exception while processing {0} data: {1}'.format(
                         message.type, sys.exc_info()[1])
                 )
             else:
+                imported.append(key)
                 if message.type == 'goals' and obj:
                     # Adjust date range for later summary retrieval
                     # For whatever reason, the end_date is not inclusive, so
@@ -106,24 +171,205 @@ def process_notification(content):
                     next_day = goal.date + arrow.util.timedelta(days=1)
                     if ownerId not in summaries:
                         summaries[ownerId] = {
-                            'misfit': misfit,
-                            'mfuser_id': mfuser.user_id,
-                            'date_range': {'start': goal.date, 'end': next_day}
-                        }
-                    elif goal.date < summaries[ownerId]['date_range']['start']:
-                        summaries[ownerId]['date_range']['start'] = goal.date
-                    elif goal.date > summaries[ownerId]['date_range']['end']:
-                        summaries[ownerId]['date_range']['end'] = next_day
-
+                            'start': goal.date, 'end': next_day}
+                    elif goal.date < summaries[ownerId]['start']:
+                        summaries[ownerId]['start'] = goal.date
+                    elif goal.date > summaries[ownerId]['end']:
+                        summaries[ownerId]['end'] = next_day
+    finally:
+        # Remember the messages we've imported, so duplicates are skipped.
+        # This is done even if a retry is coming, which then skips them, so
+        # their summaries are refreshed now too. Messages that failed are
+        # not remembered, and are processed again if redelivered.
+        cache.set_many(dict((key, True) for key in imported),
+                       utils.get_setting('MISFIT_PROCESSED_MESSAGE_TTL'))
         # Use the date ranges we built to get updated summary data
-        for ownerId, summary in summaries.items():
-            try:
-                models.Summary.import_from_misfit(
-                    summary['misfit'], summary['mfuser_id'], update=True,
-                    start_date=summary['date_range']['start'],
-                    end_date=summary['date_range']['end'])
-            except MisfitRateLimitError:
-                raise misfit_retry_exc(process_notification, sys.exc_info()[1])
+        for ownerId, date_range in summaries.items():
+            refresh_summaries.apply_async((
+                ownerId, date_range['start'].isoformat(),
+                date_range['end'].isoformat()))
+
+
+@shared_task(base=LaneTask, lane='backfill', serializer='json')
+def import_historical(misfit_user_id):
+    """
+    Import a user's historical data from Misfit starting at start_date.
+    Spin off a group of tasks, one for each data type, whose progress is
+    tracked in ImportProgress. If there is existing data, it is not
+    overwritten.
+    """
+    misfit_user = models.MisfitUser.objects.get(pk=misfit_user_id)
+    for resource_type in HISTORICAL_RESOURCE_TYPES:
+        models.ImportProgress.objects.update_or_create(
+            user_id=misfit_user.user_id, resource_type=resource_type,
+            defaults={'chunks_done': 0, 'chunks_total': 0, 'rows': 0,
+                      'started': None, 'finished': None, 'failed': False})
+    group(import_historical_cls.s(resource_type, misfit_user_id)
+          for resource_type in HISTORICAL_RESOURCE_TYPES).apply_async()
+
+
+def finish_historical_import(progress, failed=False):
+    """
+    Mark the import of one resource type as finished, and send the
+    historical_import_complete signal if it was the user's last one
+    """
+    with transaction.atomic():
+        # Lock all of the user's rows, including this one, so only the last
+        # import to finish sees that all the others have finished. They are
+        # locked in a fixed order, so concurrent imports can't deadlock.
+        rows = models.ImportProgress.objects.filter(
+            user_id=progress.user_id).order_by('pk').select_for_update()
+        complete = all(row.finished is not None
+                       for row in rows if row.pk != progress.pk)
+        progress.finished = timezone.now()
+        progress.failed = failed
+        progress.save(update_fields=['finished', 'failed'])
+    if complete:
+        signals.historical_import_complete.send(
+            sender=models.ImportProgress, user_id=progress.user_id)
+
+
+@shared_task(base=LaneTask, lane='backfill', serializer='json',
+             max_retries=None)
+def import_historical_cls(resource_type, misfit_user_id):
+    """
+    Import a user's historical data of one of HISTORICAL_RESOURCE_TYPES. The
+    user is loaded when the task runs, so the current access token is used.
+    Long imports can hit the rate limit many times, and each retry resumes
+    from the last completed chunk, so retries are not limited.
+    """
+    progress = None
+    try:
+        if resource_type not in HISTORICAL_RESOURCE_TYPES:
+            raise ValueError('Unknown resource type: %s' % resource_type)
+        misfit_user = models.MisfitUser.objects.get(pk=misfit_user_id)
+        progress, _ = models.ImportProgress.objects.get_or_create(
+            user_id=misfit_user.user_id, resource_type=resource_type)
+        if progress.started is None:
+            progress.started = timezone.now()
+            progress.save(update_fields=['started'])
+        misfit = utils.create_misfit(access_token=misfit_user.access_token)
+        getattr(models, resource_type).import_all_from_misfit(
+            misfit, misfit_user.user_id, progress=progress)
+    except MisfitRateLimitError:
+        raise misfit_retry_exc(import_historical_cls, sys.exc_info()[1])
+    except Exception:
+        exc = sys.exc_info()[1]
+        logger.exception("Unknown exception importing data: %s" % exc)
+        if progress is not None:
+            finish_historical_import(progress, failed=True)
+        raise Reject(exc, requeue=False)
+    finish_historical_import(progress)
+
+
+@shared_task(base=LaneTask, lane='refresh', serializer='json')
+def refresh_summaries(owner_id, start_date, end_date):
+    """
+    Update a Misfit user's summaries between two ISO dates, after their goals
+    have changed
+    """
+    try:
+        mfuser = models.MisfitUser.objects.get(misfit_user_id=owner_id)
+        misfit = utils.create_misfit(access_token=mfuser.access_token)
+        models.Summary.import_from_misfit(
+            misfit, mfuser.user_id, update=True,
+            start_date=arrow.get(start_date).date(),
+            end_date=arrow.get(end_date).date())
+    except MisfitRateLimitError:
+        raise misfit_retry_exc(refresh_summaries, sys.exc_info()[1])
+    except Exception:
+        exc = sys.exc_info()[1]
+        logger.exception("Unknown exception refreshing summaries: %s" % exc)
+        raise Reject(exc, requeue=False)
+
+
+@shared_task(base=LaneTask, lane='refresh', serializer='json')
+def refresh_profile(misfit_user_id):
+    """ Update a Misfit user's stored profile, when it has become stale """
+    try:
+        mfuser = models.MisfitUser.objects.get(pk=misfit_user_id)
+        misfit = utils.create_misfit(access_token=mfuser.access_token)
+        models.Profile.import_from_misfit(misfit, mfuser.user_id)
+    except MisfitRateLimitError:
+        raise misfit_retry_exc(refresh_profile, sys.exc_info()[1])
+    except Exception:
+        exc = sys.exc_info()[1]
+        logger.exception("Unknown exception refreshing profile: %s" % exc)
+        raise Reject(exc, requeue=False)
+
+
+@shared_task(base=LaneTask, lane='live', serializer='json')
+def process_notification(content):
+    """
+    Process a Misfit notification. The content is the body of the
+    notification request, decoded as UTF-8 so it can be sent as JSON.
+    """
+    if not isinstance(content, bytes):
+        content = content.encode('utf8')
+
+    try:
+        notification = utils.MisfitNotification(content)
+    except InvalidSignature:
+        logger.exception('Invalid message signature')
+        raise Reject('Invalid message signature', requeue=False)
+
+    if notification.Type == 'SubscriptionConfirmation':
+        # If the message is a subscription confirmation, then we are already
+        # finished.
+        return
+
+    # For safety (so the queue doesn't crash) wrap all this in a big try/catch
+    try:
+        window = utils.get_setting('MISFIT_NOTIFICATION_COALESCE_WINDOW')
+        if window:
+            buffer_messages(notification.Message, window)
+        else:
+            # Process each owner's messages in a task of its own, so a slow
+            # or rate limited user doesn't hold up (or retry) the others
+            owners = OrderedDict()
+            for message in notification.Message:
+                owners.setdefault(message.ownerId, []).append(message.data)
+            group(process_owner_messages.s(owner_id, messages)
+                  for owner_id, messages in owners.items()).apply_async()
+    except Exception:
+        exc = sys.exc_info()[1]
+        logger.exception("Unknown exception processing notification: %s" % exc)
+        raise Reject(exc, requeue=False)
+
+
+@shared_task(base=LaneTask, lane='live', serializer='json')
+def process_owner_messages(owner_id, messages):
+    """
+    Process the messages of a single Misfit user from a notification. The
+    messages are passed as dicts, see MisfitMessage.data.
+    """
+    try:
+        process_messages(process_owner_messages,
+                         [MisfitMessage(message) for message in messages])
+    except Retry:
+        raise
+    except Exception:
+        exc = sys.exc_info()[1]
+        logger.exception("Unknown exception processing notification: %s" % exc)
+        raise Reject(exc, requeue=False)
+
+
+@shared_task(base=LaneTask, lane='live', serializer='json')
+def process_buffered_messages(owner_id, message_type, messages=None):
+    """
+    Process the messages buffered for an owner and message type by
+    buffer_messages. On retry, the messages that were taken out of the buffer
+    are passed in directly.
+    """
+    if messages is None:
+        messages = pop_buffered_messages(owner_id, message_type)
+    try:
+        process_messages(
+            process_buffered_messages,
+            [MisfitMessage(message) for message in messages],
+            args=(owner_id, message_type, messages))
+    except Retry:
+        raise
     except Exception:
         exc = sys.exc_info()[1]
         logger.exception("Unknown exception processing notification: %s" % exc)
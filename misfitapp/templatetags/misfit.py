@@ -19,3 +19,23 @@ def is_integrated_with_misfit(user):
         {% endif %}
     """
     return utils.is_integrated(user)
+
+
+@register.simple_tag
+def prefetch_misfit_integration(users):
+    """Looks up whether each of the users is integrated, in one query.
+
+    Use this before checking many users with ``is_integrated_with_misfit``,
+    which then doesn't query the database for them. For example::
+
+        {% prefetch_misfit_integration users %}
+        {% for user in users %}
+            {{ user }}: {{ user|is_integrated_with_misfit }}
+        {% endfor %}
+
+    The results are remembered on the user objects, so ``users`` may be a
+    list or a queryset, which caches its results, but not a queryset method
+    like ``users.all``, which would load new objects each time.
+    """
+    utils.prefetch_integration(users)
+    return ''
@@ -2,6 +2,7 @@ import django
 import random
 
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.test import TestCase
 from misfit import Misfit, MisfitProfile
@@ -21,6 +22,7 @@ class MisfitTestBase(TestCase):
     TEST_SERVER = 'http://testserver'
 
     def setUp(self):
+        cache.clear()
         self.username = self.random_string(25)
         self.password = self.random_string(25)
         self.user = self.create_user(username=self.username,
@@ -36,7 +38,8 @@ class MisfitTestBase(TestCase):
             'email': 'theringbearer@example.com'
         })
 
-        self.client.login(username=self.username, password=self.password)
+        with patch('misfitapp.views.refresh_profile.delay'):
+            self.client.login(username=self.username, password=self.password)
 
     def random_string(self, length=255, extra_chars=''):
         chars = ascii_letters + extra_chars
@@ -1,7 +1,12 @@
+import datetime
+
 from django.contrib import messages
-from django.contrib.auth.models import AnonymousUser
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import HttpRequest
+from django.template import Context, Template
+from django.utils import timezone
 from misfit import Misfit
 from misfit.auth import MisfitAuth
 from misfit.exceptions import MisfitRateLimitError
@@ -9,7 +14,7 @@ from mock import patch
 
 from misfitapp import utils
 from misfitapp.decorators import misfit_integration_warning
-from misfitapp.models import MisfitUser
+from misfitapp.models import MisfitUser, Profile
 
 from .base import MisfitTestBase
 
@@ -35,6 +40,50 @@ class TestIntegrationUtility(MisfitTestBase):
         user = AnonymousUser()
         self.assertFalse(utils.is_integrated(user))
 
+    def test_is_integrated_cached(self):
+        """Integration status is cached until the MisfitUser changes."""
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertTrue(utils.is_integrated(self.user))
+            self.assertTrue(utils.is_integrated(self.user))
+        # A new request gets a new user object, but uses the cache
+        user = User.objects.get(pk=self.user.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(utils.is_integrated(user))
+        self.misfit_user.delete()
+        user = User.objects.get(pk=self.user.pk)
+        self.assertFalse(utils.is_integrated(user))
+        self.create_misfit_user(user=user)
+        user = User.objects.get(pk=self.user.pk)
+        self.assertTrue(utils.is_integrated(user))
+
+    def test_integrated_user_ids(self):
+        """Integration of many users is looked up with one query."""
+        cache.clear()
+        others = [self.create_user() for i in range(2)]
+        MisfitUser.objects.create(user=others[0], misfit_user_id='other',
+                                  access_token='token')
+        inactive = self.create_user(is_active=False)
+        MisfitUser.objects.create(user=inactive, misfit_user_id='inactive',
+                                  access_token='token')
+        users = User.objects.filter(
+            pk__in=[self.user.pk, others[0].pk, others[1].pk, inactive.pk]
+        ).order_by('pk')
+        with self.assertNumQueries(1):
+            self.assertEqual(utils.integrated_user_ids(users),
+                             set([self.user.pk, others[0].pk]))
+        user_list = list(users)
+        with self.assertNumQueries(1):
+            self.assertEqual(utils.integrated_user_ids(user_list),
+                             set([self.user.pk, others[0].pk]))
+        template = Template(
+            '{% load misfit %}{% prefetch_misfit_integration users %}'
+            '{% for user in users %}{{ user|is_integrated_with_misfit }} '
+            '{% endfor %}')
+        with self.assertNumQueries(2):
+            rendered = template.render(Context({'users': users.all()}))
+        self.assertEqual(rendered.split(), ['True', 'True', 'False', 'False'])
+
 
 class TestIntegrationDecorator(MisfitTestBase):
 
@@ -193,6 +242,7 @@ class TestCompleteView(MisfitTestBase):
         self.assertEqual(misfit_user.user, self.user)
         self.assertEqual(misfit_user.access_token, self.access_token)
         self.assertEqual(misfit_user.misfit_user_id, self.misfit_user_id)
+        mock_delay.assert_called_once_with(self.misfit_user_id)
 
     def test_unauthenticated(self):
         """User must be logged in to access Complete view."""
@@ -298,3 +348,39 @@ class TestLogoutView(MisfitTestBase):
         response = self._get(get_kwargs={'next': '/test'})
         self.assertRedirectsNoFollow(response, '/test')
         self.assertEqual(MisfitUser.objects.count(), 0)
+
+
+class TestLoginSession(MisfitTestBase):
+
+    def _login(self):
+        with patch('misfitapp.views.refresh_profile.delay') as mock_delay:
+            self.client.login(username=self.username, password=self.password)
+        return mock_delay
+
+    def test_stored_profile(self):
+        """Logging in uses the stored profile and refreshes it if stale."""
+        cache.clear()
+        mock_delay = self._login()
+        mock_delay.assert_called_once_with(self.misfit_user_id)
+        self.assertFalse('misfit_profile' in self.client.session)
+        # Refreshes are throttled
+        self.assertFalse(self._login().called)
+
+        cache.clear()
+        profile = Profile.objects.create(
+            user=self.user, email='theringbearer@example.com',
+            birthday=datetime.date(1368, 9, 22), gender='male',
+            name='Frodo Baggins')
+        self.assertFalse(self._login().called)
+        self.assertEqual(self.client.session['misfit_profile'], {
+            'userId': self.misfit_user_id,
+            'email': 'theringbearer@example.com',
+            'birthday': '1368-09-22',
+            'gender': 'male',
+            'name': 'Frodo Baggins',
+            'avatar': None,
+        })
+
+        Profile.objects.filter(pk=profile.pk).update(
+            updated=timezone.now() - datetime.timedelta(days=2))
+        self._login().assert_called_once_with(self.misfit_user_id)
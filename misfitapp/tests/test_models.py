@@ -1,7 +1,17 @@
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils.timezone import utc
 from freezegun import freeze_time
+from misfit import MisfitDevice, MisfitGoal, MisfitSleep, MisfitSummary
 from misfit.notification import MisfitMessage
+from mock import MagicMock, patch
 from misfitapp.models import (
+    ActivityRollup,
+    bulk_upsert,
+    DailyTimeline,
+    decode_sleep_segments,
     Device,
+    encode_sleep_segments,
     Goal,
     MisfitModel,
     MisfitUser,
@@ -9,9 +19,13 @@ from misfitapp.models import (
     Sleep,
     SleepSegment,
     Session,
-    Summary
+    Summary,
+    supports_native_upsert,
+    SyncState,
+    UserSnapshot
 )
 import datetime
+import warnings
 
 from .base import MisfitTestBase
 
@@ -130,3 +144,352 @@ class TestMisfitModels(MisfitTestBase):
         seg = SleepSegment(**seg_data)
         seg.save()
         self.assertEqual('%s' % seg, '%s %s' % (seg.time, seg.sleep_type))
+
+    def test_sleep_packed_segments(self):
+        """
+        Packed sleep segments decode to the same segments, and sleeps without
+        packed segments fall back to their SleepSegment rows
+        """
+        start = datetime.datetime(2014, 12, 12, 22, 0, 1, tzinfo=utc)
+        minute = datetime.timedelta(minutes=1)
+        segments = [(start, SleepSegment.AWAKE),
+                    (start + 5 * minute, SleepSegment.SLEEP),
+                    (start + 420 * minute, SleepSegment.DEEP_SLEEP)]
+        packed = encode_sleep_segments(start, segments)
+        self.assertEqual(len(packed), 5 * 3)
+        self.assertEqual(decode_sleep_segments(start, packed), segments)
+
+        sleep = Sleep.objects.create(
+            id=self.random_string(24), user=self.user, start_time=start,
+            duration=300)
+        SleepSegment.objects.create(sleep=sleep, time=start,
+                                    sleep_type=SleepSegment.SLEEP)
+        self.assertEqual([(seg.time, seg.sleep_type)
+                          for seg in sleep.get_segments()],
+                         [(start, SleepSegment.SLEEP)])
+        sleep.packed_segments = packed
+        sleep.save()
+        sleep = Sleep.objects.get(pk=sleep.pk)
+        self.assertEqual([(seg.time, seg.sleep_type)
+                          for seg in sleep.get_segments()], segments)
+
+    def test_sync_state(self):
+        """ Test the SyncState Model """
+        state = SyncState.objects.create(user=self.user,
+                                         resource_type='Goal',
+                                         high_water_date=self.today)
+        self.assertEqual(
+            '%s' % state, '%s Goal: 2014-12-12' % self.user.pk)
+
+    def test_user_time_indexes(self):
+        """
+        The importers' existence scans are covered by a composite index
+        """
+        for model, field in ((Goal, 'date'), (Session, 'start_time'),
+                             (Sleep, 'start_time')):
+            with connection.cursor() as cursor:
+                constraints = connection.introspection.get_constraints(
+                    cursor, model._meta.db_table)
+            self.assertIn(['user_id', field, 'id'], [
+                c['columns'] for c in constraints.values() if c['index']])
+
+        query = Goal.objects.filter(
+            user_id=self.user.pk, date__gte=self.today,
+            date__lte=self.today).values_list('id', flat=True).query
+        if connection.vendor == 'sqlite':
+            sql, params = query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+                plan = ' '.join(str(row[-1]) for row in cursor.fetchall())
+            self.assertIn('COVERING INDEX', plan)
+
+    def test_activity_rollup(self):
+        """
+        Weekly and monthly rollups follow the imported summaries and goals
+        """
+        def summary(date, steps):
+            return MisfitSummary({
+                'date': date, 'points': 1.5, 'steps': steps, 'calories': 2,
+                'activityCalories': 1, 'distance': 0.5})
+
+        def goal(goal_id, date, points):
+            return MisfitGoal({'id': goal_id, 'date': date, 'points': points,
+                               'targetPoints': 100})
+
+        # Sunday the 30th of November and Monday the 1st of December 2014
+        start, end = datetime.date(2014, 11, 30), datetime.date(2014, 12, 1)
+        Summary.save_misfit_chunk(
+            self.user.pk, [summary('2014-11-30', 1000),
+                           summary('2014-12-01', 2000)], start, end)
+        Goal.save_misfit_chunk(
+            self.user.pk, [goal('a' * 24, '2014-11-30', 100),
+                           goal('b' * 24, '2014-12-01', 50)], start, end)
+
+        rollups = dict(
+            ((r.period, r.period_start), r)
+            for r in ActivityRollup.objects.filter(user=self.user))
+        self.assertEqual(sorted(rollups), [
+            ('month', datetime.date(2014, 11, 1)),
+            ('month', datetime.date(2014, 12, 1)),
+            ('week', datetime.date(2014, 11, 24)),
+            ('week', datetime.date(2014, 12, 1))])
+        november = rollups[('month', datetime.date(2014, 11, 1))]
+        self.assertEqual(
+            (november.steps, november.points, november.days, november.goals,
+             november.goals_met), (1000, 1.5, 1, 1, 1))
+        week = rollups[('week', datetime.date(2014, 12, 1))]
+        self.assertEqual((week.steps, week.days, week.goals, week.goals_met),
+                         (2000, 1, 1, 0))
+
+        # Updates replace, rather than add to, the old values
+        Summary.save_misfit_chunk(
+            self.user.pk, [summary('2014-12-01', 3000)], end, end,
+            update=True)
+        week = ActivityRollup.objects.get(
+            user=self.user, period='week', period_start=end)
+        self.assertEqual((week.steps, week.days), (3000, 1))
+        self.assertEqual('%s' % week,
+                         '%s week 2014-12-01: 3000' % self.user.pk)
+
+        # Deleted goals are removed from the rollups
+        Goal.process_message(MisfitMessage({
+            'type': 'goals', 'action': 'deleted', 'id': 'b' * 24,
+            'ownerId': self.misfit_user_id}), None, self.user.pk)
+        self.assertEqual(ActivityRollup.objects.get(
+            user=self.user, period='month', period_start=end).goals, 0)
+
+    @override_settings(TIME_ZONE='America/Chicago')
+    def test_daily_timeline(self):
+        """
+        The daily timeline follows the imported summaries, goals and sleeps
+        """
+        day = datetime.date(2014, 12, 2)
+        Summary.save_misfit_chunk(self.user.pk, [MisfitSummary({
+            'date': '2014-12-02', 'points': 1.5, 'steps': 1000,
+            'calories': 2, 'activityCalories': 1, 'distance': 0.5})],
+            day, day)
+        Goal.save_misfit_chunk(self.user.pk, [MisfitGoal({
+            'id': 'a' * 24, 'date': '2014-12-02', 'points': 1.5,
+            'targetPoints': 100})], day, day)
+        # A sleep from 11pm to 7am, ending on the 2nd in Chicago
+        Sleep.import_misfit_sleeps(None, self.user.pk, [MisfitSleep({
+            'id': 'b' * 24, 'autoDetected': True,
+            'startTime': '2014-12-01T23:00:00-06:00', 'duration': 8 * 3600,
+            'sleepDetails': [
+                {'datetime': '2014-12-01T23:00:00-06:00', 'value': 1},
+                {'datetime': '2014-12-02T00:00:00-06:00', 'value': 2},
+                {'datetime': '2014-12-02T03:00:00-06:00', 'value': 3}]})])
+
+        with self.assertNumQueries(1):
+            timeline = list(DailyTimeline.objects.filter(
+                user=self.user, date__gte=day - datetime.timedelta(days=1),
+                date__lte=day).order_by('date').values_list(
+                    'date', 'steps', 'points', 'target_points',
+                    'sleep_duration', 'deep_sleep_duration'))
+        self.assertEqual(timeline, [
+            (day - datetime.timedelta(days=1), None, None, None, 0, 0),
+            (day, 1000, 1.5, 100, 7 * 3600, 4 * 3600)])
+        self.assertEqual('%s' % DailyTimeline.objects.get(date=day),
+                         '%s 2014-12-02: 1000' % self.user.pk)
+
+        Sleep.process_message(MisfitMessage({
+            'type': 'sleeps', 'action': 'deleted', 'id': 'b' * 24,
+            'ownerId': self.misfit_user_id}), None, self.user.pk)
+        self.assertEqual(
+            DailyTimeline.objects.get(date=day).sleep_duration, 0)
+
+    def test_user_snapshot(self):
+        """
+        The latest device, summary and goal state is kept in the user's
+        snapshot
+        """
+        misfit = MagicMock()
+        misfit.device.return_value = MisfitDevice({
+            'id': 'a' * 24, 'deviceType': 'shine', 'serialNumber': 'XXX',
+            'firmwareVersion': '0.0.50r', 'batteryLevel': 40,
+            'lastSyncTime': 1418421601})
+        misfit.summary.return_value = [MisfitSummary({
+            'date': day, 'points': 50, 'steps': steps, 'calories': 2,
+            'activityCalories': 1, 'distance': 0.5})
+            for day, steps in (('2014-12-11', 1000), ('2014-12-12', 2000))]
+        misfit.goal.return_value = MisfitGoal({
+            'id': 'b' * 24, 'date': '2014-12-12', 'points': 50,
+            'targetPoints': 200})
+        Device.import_from_misfit(misfit, self.user.pk)
+        Summary.import_from_misfit(
+            misfit, self.user.pk, start_date=datetime.date(2014, 12, 11),
+            end_date=datetime.date(2014, 12, 12))
+        Goal.import_from_misfit(misfit, self.user.pk, object_id='b' * 24)
+
+        with self.assertNumQueries(1):
+            snapshot = MisfitUser.objects.select_related('snapshot').get(
+                user=self.user).snapshot
+        self.assertEqual(
+            (snapshot.battery_level, snapshot.summary_date, snapshot.steps,
+             snapshot.goal_date, snapshot.goal_percent_complete()),
+            (40, datetime.date(2014, 12, 12), 2000,
+             datetime.date(2014, 12, 12), 25))
+        self.assertEqual(snapshot.last_sync_time,
+                         datetime.datetime(2014, 12, 12, 22, 0, 1, tzinfo=utc))
+        self.assertEqual('%s' % snapshot,
+                         '%s: 2014-12-12' % self.misfit_user_id)
+
+        misfit.device.return_value.batteryLevel = 30
+        Device.import_from_misfit(misfit, self.user.pk)
+        snapshot = UserSnapshot.objects.get(misfit_user=self.misfit_user)
+        self.assertEqual((snapshot.battery_level, snapshot.steps), (30, 2000))
+
+
+class TestBulkUpsert(MisfitTestBase):
+
+    def setUp(self):
+        super(TestBulkUpsert, self).setUp()
+        self.start = datetime.date(2014, 10, 5)
+        Summary.objects.create(**self._summary_data(0, steps=1))
+
+    def _summary_data(self, day, steps=100):
+        return {'user_id': self.user.pk,
+                'date': self.start + datetime.timedelta(days=day),
+                'points': 1.0,
+                'steps': steps,
+                'calories': 1.0,
+                'activity_calories': 1.0,
+                'distance': 1.0}
+
+    def _upsert(self, update_fields):
+        objs = [Summary(**self._summary_data(day)) for day in range(3)]
+        bulk_upsert(Summary, objs, ('user', 'date'),
+                    update_fields=update_fields)
+        return dict(Summary.objects.values_list('date', 'steps'))
+
+    def test_native_update(self):
+        """ Conflicting rows are updated in a single INSERT statement """
+        objs = [Summary(**self._summary_data(day)) for day in range(3)]
+        # Savepoint, INSERT, release
+        with self.assertNumQueries(3):
+            bulk_upsert(Summary, objs, ('user', 'date'),
+                        update_fields=Summary.UPDATE_FIELDS)
+        steps = dict(Summary.objects.values_list('date', 'steps'))
+        self.assertEqual(sorted(steps.values()), [100, 100, 100])
+
+    def test_native_ignore(self):
+        """ Conflicting rows are left alone without update_fields """
+        steps = self._upsert(None)
+        self.assertEqual(steps[self.start], 1)
+        self.assertEqual(len(steps), 3)
+
+    @patch('misfitapp.models.supports_native_upsert')
+    def test_fallback(self, mock_native):
+        """ Databases without ON CONFLICT get bulk_create plus updates """
+        mock_native.return_value = False
+        steps = self._upsert(None)
+        self.assertEqual(steps[self.start], 1)
+        self.assertEqual(len(steps), 3)
+        steps = self._upsert(Summary.UPDATE_FIELDS)
+        self.assertEqual(sorted(steps.values()), [100, 100, 100])
+        self.assertEqual(Summary.objects.count(), 3)
+
+    def test_native_postgresql_version(self):
+        """ ON CONFLICT is only used on PostgreSQL 9.5+ """
+        pg = MagicMock(vendor='postgresql', pg_version=90406)
+        self.assertFalse(supports_native_upsert(pg))
+        pg.pg_version = 90500
+        self.assertTrue(supports_native_upsert(pg))
+
+
+class TestQuerySets(MisfitTestBase):
+    def setUp(self):
+        super(TestQuerySets, self).setUp()
+        self.start = datetime.date(2014, 12, 1)
+        self.other_user = self.create_user()
+        for day, steps in enumerate([1000, 2000, 3000]):
+            for user in (self.user, self.other_user):
+                Summary.objects.create(
+                    user=user, date=self.start + datetime.timedelta(days=day),
+                    points=day, steps=steps, calories=10,
+                    activity_calories=5, distance=1)
+        self.start_time = datetime.datetime(2014, 12, 1, 22, tzinfo=utc)
+
+    def test_summary_totals(self):
+        """ Summary totals are summed by the database """
+        with self.assertNumQueries(1):
+            totals = Summary.objects.for_user(self.user).between(
+                self.start, self.start + datetime.timedelta(days=1)).totals()
+        self.assertEqual(totals, {
+            'points': 1, 'steps': 3000, 'calories': 20,
+            'activity_calories': 10, 'distance': 2, 'days': 2,
+            'average_steps': 1500})
+        self.assertEqual(
+            Summary.objects.for_user(self.user.pk).totals()['steps'], 6000)
+
+    def test_session_by_activity_type(self):
+        """ Sessions are grouped by activity type by the database """
+        for i, activity_type in enumerate(['walking', 'cycling', 'walking']):
+            Session.objects.create(
+                id=self.random_string(24), user=self.user,
+                activity_type=activity_type,
+                start_time=self.start_time + datetime.timedelta(days=i),
+                duration=600, points=1, steps=100, calories=10, distance=1)
+        with self.assertNumQueries(1):
+            activities = list(Session.objects.for_user(self.user).between(
+                self.start, self.start + datetime.timedelta(days=1)
+            ).by_activity_type())
+        self.assertEqual(activities, [
+            {'activity_type': 'cycling', 'sessions': 1, 'duration': 600,
+             'points': 1, 'steps': 100, 'calories': 10, 'distance': 1},
+            {'activity_type': 'walking', 'sessions': 1, 'duration': 600,
+             'points': 1, 'steps': 100, 'calories': 10, 'distance': 1}])
+        self.assertEqual([a['sessions'] for a in
+                          Session.objects.by_activity_type()], [1, 2])
+
+    def test_between_local_days(self):
+        """ Days start at midnight in the current time zone (Chicago) """
+        for sid, hour in (('late', 3), ('early', 7), ('before', 5)):
+            day = 2 if sid == 'late' else 1
+            Session.objects.create(
+                id=sid, user=self.user, activity_type='walking',
+                start_time=datetime.datetime(2014, 12, day, hour, tzinfo=utc),
+                duration=600, points=1, steps=100, calories=10, distance=1)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            ids = set(Session.objects.between(
+                datetime.date(2014, 12, 1), datetime.date(2014, 12, 1)
+            ).values_list('id', flat=True))
+        self.assertEqual(ids, set(['late', 'early']))
+        self.assertEqual(caught, [])
+
+    def test_sleep_nightly_stage_totals(self):
+        """
+        Sleep stages are totalled from the packed segments, or the segment
+        rows of sleeps that weren't packed
+        """
+        minute = datetime.timedelta(minutes=1)
+        segments = [(self.start_time, SleepSegment.AWAKE),
+                    (self.start_time + 10 * minute, SleepSegment.SLEEP),
+                    (self.start_time + 30 * minute, SleepSegment.DEEP_SLEEP)]
+        Sleep.objects.create(
+            id='a' * 24, user=self.user, start_time=self.start_time,
+            duration=60 * 60,
+            packed_segments=encode_sleep_segments(self.start_time, segments))
+        next_night = self.start_time + datetime.timedelta(days=1)
+        unpacked = Sleep.objects.create(
+            id='b' * 24, user=self.user, start_time=next_night,
+            duration=60 * 60)
+        for time, sleep_type in segments:
+            SleepSegment.objects.create(
+                sleep=unpacked, time=time + datetime.timedelta(days=1),
+                sleep_type=sleep_type)
+
+        with self.assertNumQueries(1):
+            nights = Sleep.objects.for_user(self.user).between(
+                self.start, self.start).nightly_stage_totals()
+        self.assertEqual(nights, [
+            {'id': 'a' * 24, 'start_time': self.start_time,
+             'duration': 3600, 'awake': 600, 'sleep': 1200,
+             'deep_sleep': 1800}])
+        with self.assertNumQueries(2):
+            nights = Sleep.objects.for_user(self.user).nightly_stage_totals()
+        self.assertEqual([(n['id'], n['awake'], n['sleep'], n['deep_sleep'])
+                          for n in nights],
+                         [('a' * 24, 600, 1200, 1800),
+                          ('b' * 24, 600, 1200, 1800)])
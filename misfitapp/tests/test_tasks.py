@@ -7,16 +7,17 @@ import json
 import sys
 
 from celery import Celery
-from celery.exceptions import Reject
+from celery.exceptions import Reject, Retry
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from django.core.urlresolvers import reverse
 from django.test.utils import override_settings
+from django.utils.timezone import utc
 from freezegun import freeze_time
 from httmock import HTTMock, urlmatch
 from misfit import exceptions as misfit_exceptions
-from misfit import Misfit
+from misfit import Misfit, MisfitDevice, MisfitGoal, MisfitSleep
 from misfit.notification import MisfitMessage
 from mock import call, MagicMock, patch
 from nose.tools import eq_
@@ -27,14 +28,21 @@ from misfitapp.models import (
     MisfitUser,
     Device,
     Goal,
+    ImportProgress,
     Profile,
     Session,
     Sleep,
     SleepSegment,
-    Summary
+    Summary,
+    SyncState
 )
+from misfitapp.signals import historical_import_complete
 from misfitapp.tasks import (
+    pop_buffered_messages,
+    process_buffered_messages,
     process_notification,
+    process_owner_messages,
+    refresh_summaries,
     import_historical,
     import_historical_cls,
     )
@@ -154,8 +162,18 @@ class TestImportHistoricalTask(MisfitTestBase):
     def setUp(self):
         super(TestImportHistoricalTask, self).setUp()
 
+    def start_import(self):
+        """
+        Start the user's historical import, returning the subtasks of the
+        group it sends
+        """
+        with patch('misfitapp.tasks.group') as mock_group:
+            import_historical(self.misfit_user_id)
+        mock_group.return_value.apply_async.assert_called_once_with()
+        return list(mock_group.call_args[0][0])
+
     @patch('misfitapp.models.chunkify_dates')
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     def test_import_historical(self, verify_signature_mock,
                                chunkify_dates_mock):
         chunkify_dates_mock.return_value = [
@@ -179,9 +197,23 @@ class TestImportHistoricalTask(MisfitTestBase):
                      JsonMock('goal_goals').goal_http,
                      JsonMock('session_sessions').session_http,
                      sleep_mock.sleep_http):
-            with patch('celery.app.task.Task.delay') as mock_delay:
-                mock_delay.side_effect = import_historical_cls
-                import_historical(self.misfit_user)
+            subtasks = self.start_import()
+            # Only JSON serializable ids and names are sent to the broker
+            eq_(subtasks, [import_historical_cls.s(rt, self.misfit_user_id)
+                           for rt in ('Profile', 'Device', 'Summary', 'Goal',
+                                      'Session', 'Sleep')])
+            json.dumps([subtask.args for subtask in subtasks])
+            eq_(ImportProgress.objects.filter(
+                user=self.user, finished=None).count(), 6)
+            receiver = MagicMock()
+            historical_import_complete.connect(receiver, weak=False)
+            self.addCleanup(historical_import_complete.disconnect, receiver)
+            for subtask in subtasks:
+                eq_(receiver.call_count, 0)
+                subtask()
+        receiver.assert_called_once_with(
+            signal=historical_import_complete, sender=ImportProgress,
+            user_id=self.user.pk)
 
         eq_(Profile.objects.filter(user=self.user).count(), 1)
         eq_(Device.objects.filter(user=self.user).count(), 1)
@@ -190,16 +222,43 @@ class TestImportHistoricalTask(MisfitTestBase):
         eq_(Session.objects.filter(user=self.user).count(), 2 * 5)
         eq_(Sleep.objects.filter(user=self.user).count(), 1)
         eq_(SleepSegment.objects.filter(sleep__user=self.user).count(), 2)
+        progress = dict((p.resource_type, p) for p in
+                        ImportProgress.objects.filter(user=self.user))
+        eq_([(progress[rt].chunks_done, progress[rt].chunks_total,
+              progress[rt].rows, progress[rt].failed)
+             for rt in ('Profile', 'Goal', 'Sleep')],
+            [(1, 1, 1, False), (5, 5, 2 * 5, False), (5, 5, 1, False)])
+        self.assertTrue(progress['Goal'].duration >= datetime.timedelta(0))
+
+    @patch('misfit.Misfit.device')
+    @patch('misfit.Misfit.goal')
+    def test_import_progress_rows(self, mock_goal, mock_device):
+        """ Only the rows written are counted as imported """
+        mock_device.return_value = MisfitDevice({})
+        mock_goal.return_value = [MisfitGoal(
+            {'id': 'goal', 'date': '2014-02-15', 'points': 100,
+             'targetPoints': 1000})]
+        misfit = utils.create_misfit(
+            access_token=self.misfit_user.access_token)
+        progress = ImportProgress.objects.create(
+            user=self.user, resource_type='Device')
+        Device.import_all_from_misfit(misfit, self.user.pk, progress=progress)
+        eq_(progress.rows, 0)
+        progress = ImportProgress.objects.create(
+            user=self.user, resource_type='Goal')
+        for i in range(2):
+            Goal.import_misfit_chunks(
+                misfit, self.user.pk, datetime.date(2014, 2, 1),
+                datetime.date(2014, 2, 20), progress=progress)
+        eq_((progress.chunks_done, progress.rows), (2, 1))
 
     @freeze_time("2014-07-02 10:52:00", tz_offset=0)
-    @patch('misfit.notification.MisfitNotification.verify_signature')
-    @patch('celery.app.task.Task.delay')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     @patch('celery.app.task.Task.retry')
     @patch('misfit.Misfit.device')
     @patch('logging.Logger.debug')
     def test_import_historical_rate_limit(self, mock_dbg, mock_dev,
-                                          mock_retry, mock_delay, mock_sig):
-        mock_delay.side_effect = lambda a1, a2: import_historical_cls(a1, a2)
+                                          mock_retry, mock_sig):
         eq_(Profile.objects.filter(user=self.user).count(), 0)
         eq_(Device.objects.filter(user=self.user).count(), 0)
         resp = MagicMock()
@@ -208,8 +267,10 @@ class TestImportHistoricalTask(MisfitTestBase):
         mock_dev.side_effect = exc
         mock_retry.side_effect = BaseException
         with HTTMock(JsonMock().profile_http, JsonMock().device_http):
+            subtasks = self.start_import()
+            subtasks[0]()
             try:
-                import_historical(self.misfit_user)
+                subtasks[1]()
                 assert False, 'Should have thrown an exception'
             except BaseException:
                 assert True
@@ -217,19 +278,23 @@ class TestImportHistoricalTask(MisfitTestBase):
         mock_retry.assert_called_once_with(countdown=549)
         eq_(Profile.objects.filter(user=self.user).count(), 1)
         eq_(Device.objects.filter(user=self.user).count(), 0)
+        # The device import isn't finished until it's retried
+        eq_(ImportProgress.objects.get(
+            user=self.user, resource_type='Device').finished, None)
+        # However many times that takes
+        eq_(import_historical_cls.max_retries, None)
 
     @patch('logging.Logger.exception')
-    @patch('celery.app.task.Task.delay')
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     @patch('misfitapp.utils.create_misfit')
     def test_import_historical_unknown_error(self, mock_create, mock_sig,
-                                             mock_delay, mock_exc):
+                                             mock_exc):
         """ Test that the notification task handles unknown errors ok """
         # Check that we fail gracefully when we run into an unknown error
-        mock_delay.side_effect = lambda a1, a2: import_historical_cls(a1, a2)
         mock_create.side_effect = Exception('FAKE EXCEPTION')
+        subtasks = self.start_import()
         try:
-            import_historical(self.misfit_user)
+            subtasks[0]()
             assert False, 'We should have raised an exception'
         except Reject:
             assert True
@@ -237,8 +302,267 @@ class TestImportHistoricalTask(MisfitTestBase):
             'Unknown exception importing data: FAKE EXCEPTION')
         eq_(Profile.objects.filter(user=self.user).count(), 0)
         eq_(Device.objects.filter(user=self.user).count(), 0)
+        progress = ImportProgress.objects.get(
+            user=self.user, resource_type='Profile')
+        self.assertTrue(progress.failed)
+        self.assertIsNotNone(progress.finished)
+
+    @patch('logging.Logger.exception')
+    def test_import_historical_bad_payload(self, mock_exc):
+        """ Unknown resource types and users are rejected """
+        self.assertRaises(Reject, import_historical_cls, 'MisfitUser',
+                          self.misfit_user_id)
+        mock_exc.assert_called_once_with(
+            'Unknown exception importing data: Unknown resource type: '
+            'MisfitUser')
+        self.assertRaises(Reject, import_historical_cls, 'Profile', 'nobody')
+        eq_(Profile.objects.count(), 0)
+
+    @patch('misfitapp.models.chunkify_dates')
+    @patch('misfit.Misfit.goal')
+    def test_import_streams_chunks(self, mock_goal, chunkify_dates_mock):
+        """ Chunks are committed as they arrive, before later chunks fail """
+        chunkify_dates_mock.return_value = [
+            (datetime.date(2014, 1, 1), datetime.date(2014, 1, 31)),
+            (datetime.date(2014, 1, 31), datetime.date(2014, 3, 2)),
+        ]
+        with open('misfitapp/tests/responses/goal_goals.json') as json_file:
+            goals = [MisfitGoal(goal)
+                     for goal in json.load(json_file)['goals']]
+        mock_goal.side_effect = [goals, Exception('FAKE EXCEPTION')]
+        misfit = utils.create_misfit(
+            access_token=self.misfit_user.access_token)
+        with self.assertRaises(Exception):
+            Goal.import_all_from_misfit(misfit, self.user.pk)
+        eq_(mock_goal.call_count, 2)
+        eq_(Goal.objects.filter(user=self.user).count(), 2)
+
+    @override_settings(MISFIT_IMPORT_CONCURRENCY=3)
+    @patch('misfitapp.models.chunkify_dates')
+    def test_import_concurrent(self, chunkify_dates_mock):
+        """ Chunks fetched in parallel are all imported """
+        chunkify_dates_mock.return_value = [
+            (datetime.date(2014, 1, 1), datetime.date(2014, 1, 31)),
+            (datetime.date(2014, 1, 31), datetime.date(2014, 3, 2)),
+            (datetime.date(2014, 3, 2), datetime.date(2014, 4, 1)),
+            (datetime.date(2014, 4, 1), datetime.date(2014, 5, 1)),
+            (datetime.date(2014, 5, 1), datetime.date(2014, 5, 31)),
+        ]
+        misfit = utils.create_misfit(
+            access_token=self.misfit_user.access_token)
+        with HTTMock(JsonMock('session_sessions').session_http):
+            Session.import_all_from_misfit(misfit, self.user.pk)
+        eq_(Session.objects.filter(user=self.user).count(), 2 * 5)
+
+    @override_settings(MISFIT_IMPORT_CONCURRENCY=3)
+    @patch('misfitapp.utils.RateLimitedMisfit.remaining_requests')
+    @patch('misfitapp.models.chunkify_dates')
+    def test_import_concurrent_budget(self, chunkify_dates_mock,
+                                      mock_remaining):
+        """ No more chunks are fetched at a time than requests remain """
+        chunkify_dates_mock.return_value = [
+            (datetime.date(2014, 1, 1), datetime.date(2014, 1, 31)),
+            (datetime.date(2014, 1, 31), datetime.date(2014, 3, 2)),
+            (datetime.date(2014, 3, 2), datetime.date(2014, 4, 1)),
+            (datetime.date(2014, 4, 1), datetime.date(2014, 5, 1)),
+        ]
+        mock_remaining.side_effect = [1, 1, 2]
+        misfit = utils.create_misfit(
+            access_token=self.misfit_user.access_token)
+        with HTTMock(JsonMock('session_sessions').session_http):
+            Session.import_all_from_misfit(misfit, self.user.pk)
+        # Windows of 1, 1 and 2 chunks, rather than of 3 and 1
+        eq_(mock_remaining.call_count, 3)
+        eq_(Session.objects.filter(user=self.user).count(), 2 * 4)
+
+    @override_settings(MISFIT_IMPORT_CONCURRENCY=2)
+    @patch('misfitapp.models.chunkify_dates')
+    @patch('misfit.Misfit.goal')
+    def test_import_concurrent_rate_limit(self, mock_goal,
+                                          chunkify_dates_mock):
+        """ A rate limit error stops any further chunks being fetched """
+        chunkify_dates_mock.return_value = [
+            (datetime.date(2014, 1, 1), datetime.date(2014, 1, 31)),
+            (datetime.date(2014, 1, 31), datetime.date(2014, 3, 2)),
+            (datetime.date(2014, 3, 2), datetime.date(2014, 4, 1)),
+            (datetime.date(2014, 4, 1), datetime.date(2014, 5, 1)),
+        ]
+        with open('misfitapp/tests/responses/goal_goals.json') as json_file:
+            goals = [MisfitGoal(goal)
+                     for goal in json.load(json_file)['goals']]
+        resp = MagicMock()
+        resp.headers = {'x-ratelimit-reset': 1404298869}
+        exc = misfit_exceptions.MisfitRateLimitError(429, '', resp)
+
+        def goal(start_date, end_date):
+            if start_date == datetime.date(2014, 1, 1):
+                return goals
+            raise exc
+        mock_goal.side_effect = goal
+        misfit = utils.create_misfit(
+            access_token=self.misfit_user.access_token)
+        with self.assertRaises(misfit_exceptions.MisfitRateLimitError):
+            Goal.import_all_from_misfit(misfit, self.user.pk)
+        eq_(mock_goal.call_count, 2)
+        eq_(Goal.objects.filter(user=self.user).count(), 2)
+
+    @patch('misfit.Misfit.goal')
+    def test_import_sync_state(self, mock_goal):
+        """ Later imports only fetch data newer than the user's sync state """
+        mock_goal.return_value = []
+        misfit = utils.create_misfit(
+            access_token=self.misfit_user.access_token)
+        Goal.import_all_from_misfit(misfit, self.user.pk,
+                                    start_date=datetime.date(2014, 1, 1),
+                                    end_date=datetime.date(2014, 2, 15))
+        eq_(mock_goal.call_count, 2)
+        state = SyncState.objects.get(user=self.user, resource_type='Goal')
+        eq_(state.high_water_date, datetime.date(2014, 2, 15))
+        assert state.last_success is not None
+
+        mock_goal.reset_mock()
+        Goal.import_all_from_misfit(misfit, self.user.pk,
+                                    start_date=datetime.date(2014, 1, 1),
+                                    end_date=datetime.date(2014, 2, 20))
+        mock_goal.assert_called_once_with(
+            start_date=datetime.date(2014, 2, 15),
+            end_date=datetime.date(2014, 2, 20))
+        state = SyncState.objects.get(user=self.user, resource_type='Goal')
+        eq_(state.high_water_date, datetime.date(2014, 2, 20))
+
+    @patch('misfit.Misfit.goal')
+    def test_import_sync_state_boundary(self, mock_goal):
+        """
+        Resyncs update the partly imported high-water day, up to today
+        """
+        def goal(points):
+            return MisfitGoal({'id': 'boundary-goal', 'date': '2014-02-15',
+                               'points': points, 'targetPoints': 1000})
+        misfit = utils.create_misfit(
+            access_token=self.misfit_user.access_token)
+        mock_goal.return_value = [goal(100)]
+        with freeze_time('2014-02-15 12:00:00'):
+            Goal.import_all_from_misfit(misfit, self.user.pk,
+                                        start_date=datetime.date(2014, 2, 1))
+        mock_goal.return_value = [goal(600)]
+        with freeze_time('2014-02-20 12:00:00'):
+            Goal.import_all_from_misfit(misfit, self.user.pk,
+                                        start_date=datetime.date(2014, 2, 1))
+        mock_goal.assert_called_with(start_date=datetime.date(2014, 2, 15),
+                                     end_date=datetime.date(2014, 2, 20))
+        eq_(Goal.objects.get(id='boundary-goal').points, 600)
+
+    @patch('misfit.Misfit.goal')
+    def test_import_sync_state_same_day(self, mock_goal):
+        """ Resyncs on the day of the last sync still refresh that day """
+        def goal(points):
+            return MisfitGoal({'id': 'same-day-goal', 'date': '2014-02-15',
+                               'points': points, 'targetPoints': 1000})
+        misfit = utils.create_misfit(
+            access_token=self.misfit_user.access_token)
+        for points in (100, 600):
+            mock_goal.return_value = [goal(points)]
+            with freeze_time('2014-02-15 12:00:00'):
+                Goal.import_all_from_misfit(
+                    misfit, self.user.pk, start_date=datetime.date(2014, 2, 1))
+        mock_goal.assert_called_with(start_date=datetime.date(2014, 2, 15),
+                                     end_date=datetime.date(2014, 2, 16))
+        eq_(Goal.objects.get(id='same-day-goal').points, 600)
+        state = SyncState.objects.get(user=self.user, resource_type='Goal')
+        eq_(state.high_water_date, datetime.date(2014, 2, 15))
+
+    @freeze_time("2014-07-02 10:52:00", tz_offset=0)
+    @patch('misfitapp.models.chunkify_dates')
+    @patch('celery.app.task.Task.retry')
+    @patch('misfit.Misfit.session')
+    @patch('logging.Logger.debug')
+    def test_import_historical_resume(self, mock_dbg, mock_session,
+                                      mock_retry, chunkify_dates_mock):
+        """ A rate limited import resumes from the last completed chunk """
+        chunkify_dates_mock.return_value = [
+            (datetime.date(2014, 1, 1), datetime.date(2014, 1, 31)),
+            (datetime.date(2014, 1, 31), datetime.date(2014, 3, 2)),
+        ]
+        resp = MagicMock()
+        resp.headers = {'x-ratelimit-reset': 1404298869}
+        exc = misfit_exceptions.MisfitRateLimitError(429, '', resp)
+        mock_session.side_effect = [[], exc]
+        mock_retry.side_effect = BaseException
+        try:
+            import_historical_cls('Session', self.misfit_user_id)
+            assert False, 'Should have thrown an exception'
+        except BaseException:
+            assert True
+        mock_retry.assert_called_once_with(countdown=549)
+        state = SyncState.objects.get(user=self.user, resource_type='Session')
+        eq_(state.high_water_date, datetime.date(2014, 1, 31))
+        eq_(state.last_success, None)
+
+        # The retry only fetches the chunks that weren't completed
+        chunkify_dates_mock.return_value = [
+            (datetime.date(2014, 1, 31), datetime.date(2014, 3, 2)),
+        ]
+        mock_session.side_effect = None
+        mock_session.return_value = []
+        import_historical_cls('Session', self.misfit_user_id)
+        eq_(chunkify_dates_mock.call_args[0][0], datetime.date(2014, 1, 31))
+        state = SyncState.objects.get(user=self.user, resource_type='Session')
+        eq_(state.high_water_date, datetime.date(2014, 3, 2))
+        assert state.last_success is not None
 
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    def test_import_misfit_sleeps(self):
+        """
+        Sleeps and their segments are replaced in a fixed number of queries,
+        keeping segments of different sleeps that share a timestamp
+        """
+        def misfit_sleep(sleep_id, values):
+            return MisfitSleep({
+                'id': sleep_id,
+                'autoDetected': True,
+                'startTime': '2014-05-19T23:26:54+07:00',
+                'duration': 3600,
+                'sleepDetails': [
+                    {'datetime': '2014-05-19T23:%02i:00+07:00' % i,
+                     'value': value} for i, value in enumerate(values)
+                ]})
+        sleeps = [misfit_sleep('51a4189acf12e53f80000003', [2, 1]),
+                  misfit_sleep('51a4189acf12e53f80000004', [2, 3, 1])]
+        Sleep.import_misfit_sleeps(None, self.user.pk, sleeps)
+        eq_(Sleep.objects.filter(user=self.user).count(), 2)
+        eq_(SleepSegment.objects.filter(sleep__user=self.user).count(), 5)
+
+        sleeps = [misfit_sleep('51a4189acf12e53f80000003', [3]),
+                  misfit_sleep('51a4189acf12e53f80000004', [1, 1])]
+        # Savepoint, upsert savepoint, upsert, release, delete, insert, the
+        # daily timeline's three reads, savepoint, upsert and release, release
+        with self.assertNumQueries(13):
+            Sleep.import_misfit_sleeps(None, self.user.pk, sleeps)
+        eq_(Sleep.objects.filter(user=self.user).count(), 2)
+        eq_(list(SleepSegment.objects.filter(
+            sleep__user=self.user).order_by('sleep_id', 'time').values_list(
+                'sleep_id', 'sleep_type')),
+            [('51a4189acf12e53f80000003', 3),
+             ('51a4189acf12e53f80000004', 1),
+             ('51a4189acf12e53f80000004', 1)])
+
+        # The packed segments are read without further queries
+        sleep = Sleep.objects.get(pk='51a4189acf12e53f80000004')
+        with self.assertNumQueries(0):
+            segments = sleep.get_segments()
+        eq_([(seg.time, seg.sleep_type) for seg in segments],
+            [(datetime.datetime(2014, 5, 19, 16, 0, tzinfo=utc), 1),
+             (datetime.datetime(2014, 5, 19, 16, 1, tzinfo=utc), 1)])
+
+        # Segment rows can be left out entirely
+        sleeps = [misfit_sleep('51a4189acf12e53f80000004', [2, 3])]
+        with self.settings(MISFIT_SLEEP_SEGMENT_ROWS=False):
+            Sleep.import_misfit_sleeps(None, self.user.pk, sleeps)
+        eq_(SleepSegment.objects.filter(
+            sleep_id='51a4189acf12e53f80000004').count(), 0)
+        sleep = Sleep.objects.get(pk='51a4189acf12e53f80000004')
+        eq_([seg.sleep_type for seg in sleep.get_segments()], [2, 3])
+
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     def test_import_sleep(self, verify_signature_mock):
         """ Test that calls to import sleeps are idempotent. """
         misfit = utils.create_misfit(
@@ -252,6 +576,17 @@ class TestImportHistoricalTask(MisfitTestBase):
 class TestNotificationTask(MisfitTestBase):
     def setUp(self):
         super(TestNotificationTask, self).setUp()
+        # Run the per-owner subtasks synchronously
+        conf = celery.current_app.conf
+        self.addCleanup(
+            conf.update,
+            CELERY_ALWAYS_EAGER=conf.CELERY_ALWAYS_EAGER,
+            CELERY_EAGER_PROPAGATES_EXCEPTIONS=(
+                conf.CELERY_EAGER_PROPAGATES_EXCEPTIONS))
+        conf.update(CELERY_ALWAYS_EAGER=True,
+                    CELERY_EAGER_PROPAGATES_EXCEPTIONS=True)
+        # Forget messages processed by other tests
+        cache.clear()
         self.subscription_content = {
             "Type": "SubscriptionConfirmation",
             "MessageId": "165545c9-xxxx-472c-8df2-xxxxxxxxxxx",
@@ -294,7 +629,7 @@ class TestNotificationTask(MisfitTestBase):
             'UnsubscribeURL': 'https://xxxx'
         }
 
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     def test_subscription_confirmation(self, verify_signature_mock):
         """
         Check that a task gets created to handle subscription confirmation
@@ -306,13 +641,13 @@ class TestNotificationTask(MisfitTestBase):
                 mock_delay.side_effect = lambda arg: process_notification(arg)
                 self.client.post(reverse('misfit-notification'), data=content,
                                  content_type='application/json')
-                mock_delay.assert_called_once_with(content)
+                mock_delay.assert_called_once_with(content.decode('utf8'))
         verify_signature_mock.assert_called_once_with()
         self.assertEqual(Goal.objects.count(), 0)
         self.assertEqual(Profile.objects.count(), 0)
         self.assertEqual(Summary.objects.count(), 0)
 
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     @patch('celery.app.task.Task.delay')
     def test_notification(self, mock_delay, verify_signature_mock):
         """
@@ -326,14 +661,143 @@ class TestNotificationTask(MisfitTestBase):
             content = json.dumps(self.notification_content).encode('utf8')
             self.client.post(reverse('misfit-notification'), data=content,
                              content_type='application/json')
-        mock_delay.assert_called_once_with(content)
+        mock_delay.assert_called_once_with(content.decode('utf8'))
+        eq_(Goal.objects.filter(user=self.user).count(), 2)
+        eq_(Profile.objects.filter(user=self.user).count(), 1)
+        eq_(Summary.objects.filter(user=self.user).count(), 3)
+
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.create_misfit', wraps=utils.create_misfit)
+    def test_notification_one_client_per_owner(self, mock_create,
+                                               verify_signature_mock):
+        """
+        Owners are looked up with one query and share one Misfit client
+        across all their messages
+        """
+        verify_signature_mock.return_value = None
+        content = json.dumps(self.notification_content).encode('utf8')
+        with HTTMock(JsonMock().goal_http,
+                     JsonMock().profile_http,
+                     JsonMock('summary_detail').summary_http):
+            with patch('misfitapp.models.MisfitUser.objects.in_bulk',
+                       wraps=MisfitUser.objects.in_bulk) as mock_in_bulk:
+                process_notification(content)
+        mock_in_bulk.assert_called_once_with(set([self.misfit_user_id]))
+        # The summary refresh runs in a task of its own
+        eq_(mock_create.call_args_list,
+            [call(access_token=self.access_token)] * 2)
+        eq_(Goal.objects.filter(user=self.user).count(), 2)
+        eq_(Profile.objects.filter(user=self.user).count(), 1)
+        eq_(Summary.objects.filter(user=self.user).count(), 3)
+
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.create_misfit', wraps=utils.create_misfit)
+    def test_notification_duplicate(self, mock_create, verify_signature_mock):
+        """
+        Messages that have already been processed are skipped before any
+        API calls are made
+        """
+        verify_signature_mock.return_value = None
+        content = json.dumps(self.notification_content).encode('utf8')
+        with HTTMock(JsonMock().goal_http,
+                     JsonMock().profile_http,
+                     JsonMock('summary_detail').summary_http):
+            process_notification(content)
+            eq_(mock_create.call_count, 2)
+            Goal.objects.all().delete()
+            process_notification(content)
+        eq_(mock_create.call_count, 2)
+        eq_(Goal.objects.count(), 0)
+
+        # A newer update to the same object is processed
+        messages = json.loads(self.notification_content['Message'])
+        messages[1]['updatedAt'] = '2014-10-17 14:00:00 UTC'
+        self.notification_content['Message'] = json.dumps(messages)
+        content = json.dumps(self.notification_content).encode('utf8')
+        with HTTMock(JsonMock().goal_http,
+                     JsonMock('summary_detail').summary_http):
+            process_notification(content)
+        eq_(mock_create.call_count, 4)
+        eq_(Goal.objects.count(), 1)
+
+    @patch('logging.Logger.exception')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
+    def test_notification_failed_not_recorded(self, verify_signature_mock,
+                                              mock_log):
+        """ Messages that failed to import are processed if redelivered """
+        content = json.dumps(self.notification_content).encode('utf8')
+        with patch('misfit.Misfit.goal', side_effect=Exception('FAKE')):
+            with HTTMock(JsonMock().profile_http):
+                process_notification(content)
+        eq_(Goal.objects.count(), 0)
+        eq_(Profile.objects.count(), 1)
+        with HTTMock(JsonMock().goal_http,
+                     JsonMock('summary_detail').summary_http):
+            with patch('misfit.Misfit.profile') as mock_profile:
+                process_notification(content)
+        eq_(Goal.objects.count(), 2)
+        # The profile message was imported, so it is skipped
+        eq_(mock_profile.call_count, 0)
+
+    @override_settings(MISFIT_NOTIFICATION_COALESCE_WINDOW=5)
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
+    @patch('misfitapp.tasks.process_buffered_messages.apply_async')
+    def test_notification_coalesce(self, mock_apply, verify_signature_mock):
+        """
+        Bursts of messages are buffered per owner and type, and each object
+        is only processed once
+        """
+        cache.clear()
+        content = json.dumps(self.notification_content).encode('utf8')
+        process_notification(content)
+        process_notification(content)
+        eq_(mock_apply.call_count, 2)
+        mock_apply.assert_has_calls([
+            call(args=(self.misfit_user_id, 'goals'), countdown=5),
+            call(args=(self.misfit_user_id, 'profiles'), countdown=5),
+        ], any_order=True)
+        eq_(Goal.objects.filter(user=self.user).count(), 0)
+        eq_(Profile.objects.filter(user=self.user).count(), 0)
+
+        with HTTMock(JsonMock().goal_http,
+                     JsonMock().profile_http,
+                     JsonMock('summary_detail').summary_http):
+            with patch('misfit.Misfit.goal',
+                       wraps=utils.create_misfit('FAKE').goal) as mock_goal:
+                process_buffered_messages(self.misfit_user_id, 'goals')
+                process_buffered_messages(self.misfit_user_id, 'profiles')
+                # The buffers are empty now
+                process_buffered_messages(self.misfit_user_id, 'goals')
+        eq_(mock_goal.call_count, 2)
         eq_(Goal.objects.filter(user=self.user).count(), 2)
         eq_(Profile.objects.filter(user=self.user).count(), 1)
         eq_(Summary.objects.filter(user=self.user).count(), 3)
 
+    @override_settings(MISFIT_NOTIFICATION_COALESCE_WINDOW=5)
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
+    @patch('misfitapp.tasks.process_buffered_messages.apply_async')
+    def test_notification_coalesce_late(self, mock_apply,
+                                        verify_signature_mock):
+        """
+        Buffered messages wait however late they are processed, and overdue
+        buffers are scheduled again
+        """
+        cache.clear()
+        content = json.dumps(self.notification_content).encode('utf8')
+        with freeze_time('2014-07-02 10:52:00'):
+            process_notification(content)
+        with freeze_time('2014-07-02 10:52:30'):
+            process_notification(content)
+        eq_(mock_apply.call_count, 2)
+        with freeze_time('2014-07-03 10:52:00'):
+            process_notification(content)
+        eq_(mock_apply.call_count, 4)
+        messages = pop_buffered_messages(self.misfit_user_id, 'goals')
+        eq_(len(messages), 2)
+
     @freeze_time("2014-07-02 10:52:00", tz_offset=0)
     @patch('logging.Logger.debug')
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     @patch('celery.app.task.Task.delay')
     @patch('misfit.Misfit.goal')
     @patch('celery.app.task.Task.retry')
@@ -355,7 +819,7 @@ class TestNotificationTask(MisfitTestBase):
                 assert False, 'We should have raised an exception'
             except Exception:
                 assert True
-        mock_delay.assert_called_once_with(content)
+        mock_delay.assert_called_once_with(content.decode('utf8'))
         mock_goal.assert_called_once_with(object_id='51a4189acf12e53f81000001')
         mock_retry.assert_called_once_with(countdown=549)
         eq_(Goal.objects.filter(user=self.user).count(), 0)
@@ -364,7 +828,7 @@ class TestNotificationTask(MisfitTestBase):
 
     @freeze_time("2014-07-02 10:52:00", tz_offset=0)
     @patch('logging.Logger.debug')
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     @patch('celery.app.task.Task.delay')
     @patch('misfit.Misfit.summary')
     @patch('celery.app.task.Task.retry')
@@ -388,7 +852,7 @@ class TestNotificationTask(MisfitTestBase):
                 assert False, 'We should have raised an exception'
             except Exception:
                 assert True
-        mock_delay.assert_called_once_with(content)
+        mock_delay.assert_called_once_with(content.decode('utf8'))
         mock_summ.assert_called_once_with(
             detail=True,
             end_date=datetime.date(2014, 10, 8),
@@ -400,7 +864,7 @@ class TestNotificationTask(MisfitTestBase):
 
     @patch('logging.Logger.exception')
     @patch('celery.app.task.Task.delay')
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     @patch('misfitapp.models.Profile.process_message')
     def test_notification_badrequest(self, mock_process, mock_verify,
                                      mock_delay, mock_exc):
@@ -428,7 +892,7 @@ class TestNotificationTask(MisfitTestBase):
 
     @patch('logging.Logger.exception')
     @patch('celery.app.task.Task.delay')
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     @patch('misfitapp.models.Profile.process_message')
     def test_notification_process_error(self, mock_process, mock_verify,
                                         mock_delay, mock_exc):
@@ -455,7 +919,7 @@ class TestNotificationTask(MisfitTestBase):
 
     @patch('logging.Logger.exception')
     @patch('celery.app.task.Task.delay')
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     @patch('misfitapp.utils.create_misfit')
     def test_notification_unknown_error(self, mock_create, mock_sig,
                                         mock_delay, mock_exc):
@@ -463,20 +927,79 @@ class TestNotificationTask(MisfitTestBase):
         # Check that we fail gracefully when we run into an unknown error
         mock_delay.side_effect = lambda arg: process_notification(arg)
         mock_create.side_effect = Exception('FAKE EXCEPTION')
-        try:
-            content = json.dumps(self.notification_content).encode('utf8')
-            self.client.post(reverse('misfit-notification'), data=content,
-                             content_type='application/json')
-            assert False, 'We should have raised an exception'
-        except Reject:
-            assert True
+        # The error is contained in the owner's subtask, which is rejected
+        content = json.dumps(self.notification_content).encode('utf8')
+        self.client.post(reverse('misfit-notification'), data=content,
+                         content_type='application/json')
         mock_exc.assert_called_once_with(
             'Unknown exception processing notification: FAKE EXCEPTION')
+        messages = json.loads(self.notification_content['Message'])
+        with self.assertRaises(Reject):
+            process_owner_messages(self.misfit_user_id, messages)
         eq_(Goal.objects.filter(user=self.user).count(), 0)
         eq_(Profile.objects.filter(user=self.user).count(), 0)
         eq_(Summary.objects.filter(user=self.user).count(), 0)
 
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @freeze_time("2014-07-02 10:52:00", tz_offset=0)
+    @patch('logging.Logger.debug')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
+    @patch('celery.app.task.Task.retry')
+    def test_notification_owner_subtasks(self, mock_retry, mock_sig,
+                                         debug_mock):
+        """
+        Each owner's messages are processed in their own subtask, so a rate
+        limited owner only retries their own messages
+        """
+        other_user = self.create_user()
+        other_id = '51a4189acf12e53f79000002'
+        self.create_misfit_user(user=other_user, misfit_user_id=other_id,
+                                access_token='OTHER_TOKEN')
+        self.notification_content['Message'] = json.dumps([{
+            "type": "devices",
+            "action": "updated",
+            "id": "1234",
+            "ownerId": other_id,
+            "updatedAt": "2014-10-17 12:00:00 UTC"
+        }, {
+            "type": "devices",
+            "action": "updated",
+            "id": "1235",
+            "ownerId": self.misfit_user_id,
+            "updatedAt": "2014-10-17 12:00:00 UTC"
+        }])
+        resp = MagicMock()
+        resp.headers = {'x-ratelimit-reset': 1404298869}
+        exc = misfit_exceptions.MisfitRateLimitError(429, '', resp)
+        device_http = JsonMock().device_http
+
+        @urlmatch(scheme='https', netloc=r'api\.misfitwearables\.com')
+        def rate_limited_device_http(url, request):
+            if 'OTHER_TOKEN' in request.headers['Authorization']:
+                raise exc
+            return device_http(url, request)
+
+        content = json.dumps(self.notification_content).encode('utf8')
+        with patch('misfitapp.tasks.group') as mock_group:
+            process_notification(content)
+        subtasks = list(mock_group.call_args[0][0])
+        messages = json.loads(self.notification_content['Message'])
+        eq_(subtasks, [process_owner_messages.s(other_id, messages[:1]),
+                       process_owner_messages.s(self.misfit_user_id,
+                                                messages[1:])])
+        mock_group.return_value.apply_async.assert_called_once_with()
+
+        mock_retry.side_effect = Retry
+        with HTTMock(rate_limited_device_http):
+            for subtask in subtasks:
+                try:
+                    subtask()
+                except Retry:
+                    pass
+        mock_retry.assert_called_once_with(countdown=549)
+        eq_(Device.objects.filter(user=self.user).count(), 1)
+        eq_(Device.objects.filter(user=other_user).count(), 0)
+
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     @patch('celery.app.task.Task.delay')
     @patch('logging.Logger.warning')
     def test_notification_no_user(self, mock_warning, mock_delay, mock_sig):
@@ -489,7 +1012,7 @@ class TestNotificationTask(MisfitTestBase):
             content = json.dumps(self.notification_content).encode('utf8')
             self.client.post(reverse('misfit-notification'), data=content,
                              content_type='application/json')
-        mock_delay.assert_called_once_with(content)
+        mock_delay.assert_called_once_with(content.decode('utf8'))
         mock_warning.assert_has_calls([call(
             'Received a notification for a user who is not in our database '
             'with id: %s' % self.misfit_user_id)] * 3)
@@ -682,7 +1205,7 @@ class TestNotificationTask(MisfitTestBase):
         Session.process_message(MisfitMessage(message), misfit, self.user.pk)
         eq_(Session.objects.filter(user_id=self.user.pk).count(), 0)
 
-    @patch('misfit.notification.MisfitNotification.verify_signature')
+    @patch('misfitapp.utils.MisfitNotification.verify_signature')
     def test_sleep(self, verify_signature_mock):
 
         # Create
@@ -731,3 +1254,23 @@ class TestNotificationTask(MisfitTestBase):
         Sleep.process_message(MisfitMessage(message), misfit, self.user.pk)
         eq_(Sleep.objects.filter(user_id=self.user.pk).count(), 0)
         eq_(SleepSegment.objects.filter(sleep=sleep).count(), 0)
+
+
+class TestTaskLanes(MisfitTestBase):
+    @override_settings(MISFIT_TASK_LANES={
+        'live': {'queue': 'misfit-live', 'priority': 9},
+        'backfill': {'queue': 'misfit-backfill'}})
+    @patch('celery.app.task.Task.apply_async')
+    def test_lane_options(self, mock_apply):
+        """
+        Tasks are sent with the options of their lane, unless overridden
+        """
+        import_historical.delay(self.misfit_user_id)
+        process_notification.apply_async((b'content',), priority=1)
+        refresh_summaries.delay(self.misfit_user_id, '2014-10-05',
+                                '2014-10-08')
+        eq_(mock_apply.call_args_list, [
+            call((self.misfit_user_id,), {}, queue='misfit-backfill'),
+            call((b'content',), None, queue='misfit-live', priority=1),
+            call((self.misfit_user_id, '2014-10-05', '2014-10-08'), {}),
+        ])
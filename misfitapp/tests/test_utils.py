@@ -1,7 +1,14 @@
+import requests
+import time
+
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 from misfit import Misfit
+from misfit.exceptions import MisfitRateLimitError
+from mock import patch
 
+from misfitapp import utils
 from misfitapp.utils import create_misfit, get_setting
 
 
@@ -18,10 +25,186 @@ class TestMisfitUtilities(TestCase):
         with self.settings(MISFIT_CLIENT_ID=None, MISFIT_CLIENT_SECRET=''):
             self.assertRaises(ImproperlyConfigured, create_misfit, 'token')
         api = create_misfit('token')
-        self.assertEqual(api.__class__, Misfit)
+        self.assertEqual(api.__class__, utils.RateLimitedMisfit)
+        self.assertIsInstance(api, Misfit)
+
+    def test_create_misfit_pool(self):
+        """
+        Check that Misfit objects are reused per access token, and the least
+        recently used ones are discarded when the pool is full.
+        """
+        utils._misfit_clients.clear()
+        api = create_misfit('token')
+        self.assertIs(create_misfit('token'), api)
+        self.assertIsNot(create_misfit('other-token'), api)
+        self.assertIsNot(create_misfit('token', user_id='me'), api)
+        with self.settings(MISFIT_CLIENT_POOL_SIZE=1):
+            create_misfit('third-token')
+        self.assertIsNot(create_misfit('token'), api)
 
     def test_get_setting_error(self):
         """
         Check that an error is raised when trying to get a nonexistent setting.
         """
         self.assertRaises(ImproperlyConfigured, get_setting, 'DOES_NOT_EXIST')
+
+
+class TestSigningCertificate(TestCase):
+    url = 'https://sns.us-east-1.amazonaws.com/cert.pem'
+
+    def setUp(self):
+        utils._signing_certs.clear()
+        cache.clear()
+
+    @patch('misfitapp.utils.load_pem_x509_certificate')
+    @patch('requests.get')
+    def test_cached(self, mock_get, mock_load):
+        """
+        The certificate is only downloaded once, and only parsed again when
+        it's not in the in-process cache
+        """
+        mock_get.return_value.content = b'PEM'
+        cert = utils.get_signing_certificate(self.url)
+        self.assertEqual(cert, mock_load.return_value)
+        self.assertEqual(utils.get_signing_certificate(self.url), cert)
+        mock_get.assert_called_once_with(self.url)
+        self.assertEqual(mock_load.call_count, 1)
+
+        # Another process would find the certificate in the Django cache
+        utils._signing_certs.clear()
+        utils.get_signing_certificate(self.url)
+        mock_get.assert_called_once_with(self.url)
+        self.assertEqual(mock_load.call_count, 2)
+        self.assertEqual(mock_load.call_args[0][0], b'PEM')
+
+    @patch('requests.get')
+    def test_bad_download(self, mock_get):
+        """ Failed or invalid downloads are not cached """
+        error = requests.Response()
+        error.status_code = 503
+        error._content = b'<html>Service Unavailable</html>'
+        invalid = requests.Response()
+        invalid.status_code = 200
+        invalid._content = b'<html>Not a certificate</html>'
+        valid = requests.Response()
+        valid.status_code = 200
+        valid._content = b'PEM'
+        mock_get.return_value = error
+        with self.assertRaises(requests.HTTPError):
+            utils.get_signing_certificate(self.url)
+        mock_get.return_value = invalid
+        with self.assertRaises(ValueError):
+            utils.get_signing_certificate(self.url)
+        mock_get.return_value = valid
+        with patch('misfitapp.utils.load_pem_x509_certificate') as mock_load:
+            cert = utils.get_signing_certificate(self.url)
+            self.assertEqual(cert, mock_load.return_value)
+            self.assertEqual(utils.get_signing_certificate(self.url), cert)
+        self.assertEqual(mock_get.call_count, 3)
+
+    @patch('misfitapp.utils.load_pem_x509_certificate')
+    @patch('requests.get')
+    def test_expiry_and_eviction(self, mock_get, mock_load):
+        """ Entries expire after the timeout and are evicted LRU first """
+        mock_get.return_value.content = b'PEM'
+        with self.settings(MISFIT_SIGNING_CERT_TIMEOUT=-1):
+            utils.get_signing_certificate(self.url)
+            utils.get_signing_certificate(self.url)
+        self.assertEqual(mock_get.call_count, 2)
+
+        with self.settings(MISFIT_SIGNING_CERT_CACHE_SIZE=2):
+            for i in range(3):
+                utils.get_signing_certificate(self.url + str(i))
+        self.assertEqual(list(utils._signing_certs.keys()),
+                         [self.url + '1', self.url + '2'])
+
+    @patch('misfitapp.utils.get_signing_certificate')
+    def test_verify_signature(self, mock_cert):
+        """ Notifications are verified against the cached certificate """
+        content = ('{"Type": "Notification", "Message": "[]", '
+                   '"Signature": "c2ln", "SigningCertURL": "%s"}' %
+                   self.url).encode('utf8')
+        notification = utils.MisfitNotification(content)
+        self.assertEqual(notification.Message, [])
+        mock_cert.assert_called_once_with(self.url)
+        pubkey = mock_cert.return_value.public_key.return_value
+        self.assertEqual(pubkey.verify.call_args[0][0], b'sig')
+
+
+class TestRateLimit(TestCase):
+    def setUp(self):
+        utils._misfit_clients.clear()
+        cache.clear()
+
+    @patch('misfit.Misfit._get_object')
+    def test_token_bucket(self, mock_get_object):
+        """
+        API calls beyond the per-user limit are refused without calling the
+        API, with the time the limit resets
+        """
+        mock_get_object.return_value = {}
+        with self.settings(MISFIT_USER_RATE_LIMIT=(2, 60)):
+            api = create_misfit('token')
+            api.device()
+            api.device()
+            with self.assertRaises(MisfitRateLimitError) as cm:
+                api.device()
+            reset = cm.exception.response.headers['x-ratelimit-reset']
+            self.assertTrue(time.time() < reset <= time.time() + 31)
+            # Other users have their own bucket
+            create_misfit('other-token').device()
+        self.assertEqual(mock_get_object.call_count, 3)
+
+        with self.settings(MISFIT_APP_RATE_LIMIT=(1, 60)):
+            create_misfit('other-token').device()
+            self.assertRaises(MisfitRateLimitError,
+                              create_misfit('third-token').device)
+        self.assertEqual(mock_get_object.call_count, 4)
+
+    @patch('misfit.Misfit._get_object')
+    def test_token_bucket_shared(self, mock_get_object):
+        """
+        Calls refused by one bucket don't use up the tokens of the other
+        """
+        mock_get_object.return_value = {}
+        with self.settings(MISFIT_USER_RATE_LIMIT=(1, 60),
+                           MISFIT_APP_RATE_LIMIT=(3, 60)):
+            throttled = create_misfit('throttled-token')
+            throttled.device()
+            for i in range(5):
+                self.assertRaises(MisfitRateLimitError, throttled.device)
+            # The app still has tokens for other users
+            create_misfit('other-token').device()
+            create_misfit('third-token').device()
+            self.assertRaises(MisfitRateLimitError,
+                              create_misfit('fourth-token').device)
+            # The user token taken for the refused call was given back
+            with self.settings(MISFIT_APP_RATE_LIMIT=None):
+                create_misfit('fourth-token').device()
+        self.assertEqual(mock_get_object.call_count, 4)
+
+    @patch('misfit.Misfit._get_object')
+    def test_rate_limit_headers(self, mock_get_object):
+        """
+        Once Misfit reports no remaining requests, API calls are refused
+        until the limit resets
+        """
+        mock_get_object.return_value = {}
+        api = create_misfit('token')
+        response = requests.Response()
+        reset = int(time.time()) + 100
+        response.headers.update({'x-ratelimit-remaining': '1',
+                                 'x-ratelimit-reset': str(reset)})
+        self.assertIsNone(api.remaining_requests())
+        api.track_rate_limit(response)
+        self.assertEqual(api.remaining_requests(), 1)
+        api.device()
+        response.headers['x-ratelimit-remaining'] = '0'
+        api.track_rate_limit(response)
+        self.assertEqual(api.remaining_requests(), 0)
+        with self.assertRaises(MisfitRateLimitError) as cm:
+            api.device()
+        self.assertEqual(
+            cm.exception.response.headers['x-ratelimit-reset'], reset)
+        create_misfit('other-token').device()
+        self.assertEqual(mock_get_object.call_count, 2)
@@ -1,19 +1,228 @@
+import hashlib
+import math
+import requests
+import threading
+import time
+
+from base64 import standard_b64decode
+from collections import OrderedDict
+from contextlib import contextmanager
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+from cryptography.x509 import load_pem_x509_certificate
 from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
+from django.db.models.query import QuerySet
 
 from misfit.auth import MisfitAuth
 from misfit import Misfit
+from misfit import notification
+from misfit.exceptions import MisfitRateLimitError
 
 from . import defaults
-from .models import MisfitUser
+from .models import INTEGRATION_CACHE_KEY, MisfitUser
+
+
+class LRUCache(object):
+    """
+    A small thread-safe, in-process least recently used cache, whose entries
+    can optionally expire
+    """
+
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the value for key, or None if missing or expired """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                return None
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, max_size, timeout=None):
+        """
+        Store value for key, for timeout seconds if given, evicting the least
+        recently used entries beyond max_size
+        """
+        expires = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > max_size:
+                self._data.popitem(last=False)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+@contextmanager
+def cache_lock(key, timeout=10):
+    """
+    A simple lock shared by all workers through the Django cache. It is
+    released after timeout seconds even if the holder dies.
+    """
+    lock_key = '%s-lock' % key
+    while not cache.add(lock_key, True, timeout):
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        cache.delete(lock_key)
+
+
+def _bucket_tokens(key, rate, now):
+    """ The tokens in the token bucket under key at time now """
+    capacity, period = rate
+    tokens, updated = cache.get(key, (capacity, now))
+    return min(capacity, tokens + (now - updated) * capacity / period)
+
+
+def take_token(key, rate):
+    """
+    Take a token from the token bucket stored in the Django cache under key,
+    which holds up to rate[0] tokens and refills at rate[0] tokens every
+    rate[1] seconds. Returns 0 if a token was taken, otherwise the number of
+    seconds until one will be available.
+    """
+    capacity, period = rate
+    with cache_lock(key):
+        now = time.time()
+        tokens = _bucket_tokens(key, rate, now)
+        if tokens < 1:
+            return (1 - tokens) * period / capacity
+        cache.set(key, (tokens - 1, now), period)
+    return 0
+
+
+def return_token(key, rate):
+    """ Put back a token taken by take_token that wasn't used """
+    capacity, period = rate
+    with cache_lock(key):
+        now = time.time()
+        tokens = _bucket_tokens(key, rate, now)
+        cache.set(key, (min(capacity, tokens + 1), now), period)
+
+
+class RateLimitedMisfit(Misfit):
+    """
+    A Misfit API client that waits its turn instead of running into the
+    Misfit rate limit. Before every API call a token is taken from the
+    per-app (MISFIT_APP_RATE_LIMIT) and per-user (MISFIT_USER_RATE_LIMIT)
+    token buckets, and the x-ratelimit-remaining and x-ratelimit-reset
+    headers of every response are tracked. All of this state is kept in the
+    Django cache, so it is shared by all workers. When the limit has been
+    reached, a MisfitRateLimitError is raised without calling the API, with
+    the same x-ratelimit-reset header Misfit would have sent.
+    """
+
+    def __init__(self, client_id, client_secret, access_token, **kwargs):
+        Misfit.__init__(self, client_id, client_secret, access_token,
+                        **kwargs)
+        self.rate_limit_key = 'misfit-rate-limit-%s' % hashlib.sha1(
+            access_token.encode('utf8')).hexdigest()
+        self.app_rate_limit_key = 'misfit-rate-limit-app-%s' % client_id
+        self.api._store['session'].hooks['response'].append(
+            self.track_rate_limit)
+
+    def track_rate_limit(self, response, *args, **kwargs):
+        """
+        Remember how many requests the user has remaining until their rate
+        limit resets, and when it resets once there are none remaining
+        """
+        remaining = response.headers.get('x-ratelimit-remaining')
+        reset = response.headers.get('x-ratelimit-reset')
+        if remaining is not None and reset is not None:
+            timeout = int(reset) - time.time()
+            if timeout > 0:
+                cache.set('%s-remaining' % self.rate_limit_key,
+                          int(remaining), int(timeout) + 1)
+                if int(remaining) < 1:
+                    cache.set('%s-reset' % self.rate_limit_key, int(reset),
+                              int(timeout) + 1)
+
+    def remaining_requests(self):
+        """
+        Returns the number of requests Misfit last reported the user has
+        remaining before their rate limit resets, or None if unknown
+        """
+        return cache.get('%s-remaining' % self.rate_limit_key)
+
+    def reset_time(self):
+        """
+        Returns None and takes a token from the buckets if an API call may be
+        made now, otherwise the timestamp at which the next call may be made
+        """
+        reset = cache.get('%s-reset' % self.rate_limit_key)
+        if reset is not None and reset > time.time():
+            return reset
+        # The user's bucket comes first, and tokens are given back when a
+        # later bucket refuses the call, so throttled users don't use up the
+        # app's budget
+        buckets = ((self.rate_limit_key, 'MISFIT_USER_RATE_LIMIT'),
+                   (self.app_rate_limit_key, 'MISFIT_APP_RATE_LIMIT'))
+        taken = []
+        for key, setting in buckets:
+            rate = get_setting(setting)
+            if rate is not None:
+                wait = take_token(key, rate)
+                if wait:
+                    for taken_key, taken_rate in taken:
+                        return_token(taken_key, taken_rate)
+                    return int(math.ceil(time.time() + wait))
+                taken.append((key, rate))
+        return None
+
+    def _get_object(self, *args, **kwargs):
+        reset = self.reset_time()
+        if reset is not None:
+            response = requests.Response()
+            response.status_code = 429
+            response.headers['x-ratelimit-reset'] = reset
+            raise MisfitRateLimitError(
+                429, 'Rate limit reached, not calling the Misfit API',
+                response)
+        return Misfit._get_object(self, *args, **kwargs)
+
+
+# Pooled Misfit API clients, keyed by the arguments they were created with
+_misfit_clients = LRUCache()
+# Parsed SNS signing certificates, keyed by URL
+_signing_certs = LRUCache()
 
 
 def create_misfit(access_token, client_id=None, client_secret=None, **kwargs):
-    """ Shortcut to create a Misfit instance. """
+    """
+    Shortcut to create a Misfit instance.
+
+    Instances are pooled by access token (and the other arguments), up to
+    MISFIT_CLIENT_POOL_SIZE of them, so repeated calls for the same user
+    reuse one client and its keep-alive HTTP connections.
+    """
 
     client_key, client_secret = get_client_id_and_secret(
         client_id=client_id, client_secret=client_secret)
-    return Misfit(client_key, client_secret, access_token, **kwargs)
+    key = (client_key, client_secret, access_token) + tuple(
+        sorted(kwargs.items()))
+    misfit = _misfit_clients.get(key)
+    if misfit is None:
+        misfit = RateLimitedMisfit(
+            client_key, client_secret, access_token, **kwargs)
+        _misfit_clients.set(
+            key, misfit, get_setting('MISFIT_CLIENT_POOL_SIZE'))
+    return misfit
 
 
 def create_misfit_auth(**kwargs):
@@ -37,16 +246,117 @@ def get_client_id_and_secret(client_id=None, client_secret=None):
 
     return (client_id, client_secret)
 
+def get_signing_certificate(url):
+    """
+    Returns the parsed x509 certificate that SNS notifications are signed
+    with. Certificates are cached by URL for MISFIT_SIGNING_CERT_TIMEOUT
+    seconds, both in the Django cache (so workers share downloads) and in an
+    in-process LRU of MISFIT_SIGNING_CERT_CACHE_SIZE entries (so verification
+    is a pure CPU operation after the first hit).
+    """
+    cert = _signing_certs.get(url)
+    if cert is not None:
+        return cert
+
+    timeout = get_setting('MISFIT_SIGNING_CERT_TIMEOUT')
+    cache_key = 'misfit-signing-cert-%s' % hashlib.sha1(
+        url.encode('utf8')).hexdigest()
+    cert_str = cache.get(cache_key)
+    if cert_str is None:
+        response = requests.get(url)
+        response.raise_for_status()
+        cert_str = response.content
+        # Parse before caching, so a bad download isn't shared with every
+        # worker until the timeout
+        cert = load_pem_x509_certificate(cert_str, default_backend())
+        cache.set(cache_key, cert_str, timeout)
+    else:
+        cert = load_pem_x509_certificate(cert_str, default_backend())
+    _signing_certs.set(
+        url, cert, get_setting('MISFIT_SIGNING_CERT_CACHE_SIZE'),
+        timeout=timeout)
+    return cert
+
+
+class MisfitNotification(notification.MisfitNotification):
+    """
+    A MisfitNotification that verifies its signature against a cached
+    signing certificate, see :py:func:`get_signing_certificate`
+    """
+
+    def verify_signature(self):
+        """
+        Verify the signature of the SNS message.
+
+        raises cryptography.exceptions.InvalidSignature
+        """
+        pubkey = get_signing_certificate(
+            self.data['SigningCertURL']).public_key()
+        signature = standard_b64decode(self.data['Signature'].encode('utf8'))
+        pubkey.verify(signature, notification.string_to_sign(self.data),
+                      PKCS1v15(), hashes.SHA1())
+
+
 def is_integrated(user):
     """Returns ``True`` if we have OAuth info for the user.
 
     This does not require that the access token is valid.
 
+    The result is remembered on the user object for the rest of the request,
+    and in the cache for :ref:`MISFIT_INTEGRATION_CACHE_TIMEOUT` seconds or
+    until the user's MisfitUser is saved or deleted.
+
     :param user: A Django User.
     """
-    if user.is_authenticated() and user.is_active:
-        return MisfitUser.objects.filter(user=user).exists()
-    return False
+    if not (user.is_authenticated() and user.is_active):
+        return False
+    integrated = getattr(user, '_misfit_integrated', None)
+    if integrated is None:
+        key = INTEGRATION_CACHE_KEY % user.pk
+        integrated = cache.get(key)
+        if integrated is None:
+            integrated = MisfitUser.objects.filter(user=user).exists()
+            cache.set(key, integrated,
+                      get_setting('MISFIT_INTEGRATION_CACHE_TIMEOUT'))
+        user._misfit_integrated = integrated
+    return integrated
+
+
+def integrated_user_ids(users):
+    """Returns the set of primary keys of the users we have OAuth info for.
+
+    This checks all of the users with a single query, where calling
+    :py:func:`is_integrated` for each would make one query per user.
+
+    :param users: An iterable of Django Users, such as a queryset. A
+        queryset is used as a subquery, without loading the users.
+    """
+    if isinstance(users, QuerySet):
+        user_ids = users.values('pk')
+    else:
+        user_ids = [user.pk for user in users if user.is_authenticated()]
+        if not user_ids:
+            return set()
+    return set(MisfitUser.objects.filter(
+        user__in=user_ids, user__is_active=True
+    ).values_list('user_id', flat=True))
+
+
+def prefetch_integration(users):
+    """Looks up whether each of the users is integrated, in one query.
+
+    The results are remembered on the user objects, so later calls to
+    :py:func:`is_integrated` for them, for example by the
+    ``is_integrated_with_misfit`` template filter, don't query the database.
+
+    :param users: An iterable of Django Users, such as a queryset.
+    """
+    users = list(users)
+    user_ids = integrated_user_ids(users)
+    for user in users:
+        if user.is_authenticated():
+            user._misfit_integrated = user.pk in user_ids
+    return users
 
 
 def get_setting(name, use_defaults=True):
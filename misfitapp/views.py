@@ -1,9 +1,12 @@
 import json
+import logging
 
+from datetime import timedelta
 from dateutil import parser
 from dateutil.relativedelta import relativedelta
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
 from django.core.exceptions import ImproperlyConfigured
 from django.core.urlresolvers import reverse
 from django.dispatch import receiver
@@ -15,8 +18,10 @@ from django.views.decorators.http import require_POST
 from misfit.notification import MisfitNotification
 
 from . import utils
-from .models import MisfitUser
-from .tasks import process_notification, import_historical
+from .models import MisfitUser, Profile
+from .tasks import process_notification, import_historical, refresh_profile
+
+logger = logging.getLogger(__name__)
 
 
 @login_required
@@ -93,7 +98,7 @@ def complete(request):
     request.session['misfit_profile'] = profile.data
 
     # Import their data
-    import_historical.delay(misfit_user)
+    import_historical.delay(misfit_user.pk)
 
     next_url = request.session.pop('misfit_next', None) or utils.get_setting(
         'MISFIT_LOGIN_REDIRECT')
@@ -102,17 +107,39 @@ def complete(request):
 
 @receiver(user_logged_in)
 def create_misfit_session(sender, request, user, **kwargs):
-    """ If the user is a Misfit user, update the profile in the session. """
+    """
+    If the user is a Misfit user, put their stored profile in the session,
+    and refresh it from Misfit in the background if it is stale.
+    """
 
     if (user.is_authenticated() and utils.is_integrated(user) and
             user.is_active):
-        misfit_user = MisfitUser.objects.filter(user=user)
-        if misfit_user.exists():
-            api = utils.create_misfit(misfit_user[0].access_token)
-            try:
-                request.session['misfit_profile'] = api.profile().data
-            except:
-                pass
+        misfit_user = MisfitUser.objects.filter(user=user).first()
+        if misfit_user is None:
+            return
+        profile = Profile.objects.filter(user=user).first()
+        if profile is not None:
+            request.session['misfit_profile'] = {
+                'userId': misfit_user.misfit_user_id,
+                'email': profile.email,
+                'birthday': profile.birthday.isoformat(),
+                'gender': profile.gender,
+                'name': profile.name,
+                'avatar': profile.avatar,
+            }
+        max_age = timedelta(
+            seconds=utils.get_setting('MISFIT_PROFILE_MAX_AGE'))
+        if (profile is None or profile.updated is None or
+                profile.updated < timezone.now() - max_age):
+            # Only one refresh per throttle period, however often they log in
+            throttle_key = 'misfit-profile-refresh-%s' % misfit_user.pk
+            if cache.add(throttle_key, True, utils.get_setting(
+                    'MISFIT_PROFILE_REFRESH_THROTTLE')):
+                try:
+                    refresh_profile.delay(misfit_user.pk)
+                except Exception:
+                    # Never fail the login because the refresh can't be sent
+                    logger.exception('Could not start profile refresh')
 
 
 @login_required
@@ -164,5 +191,5 @@ def logout(request):
 @csrf_exempt
 @require_POST
 def notification(request):
-    process_notification.delay(request.body)
+    process_notification.delay(request.body.decode('utf8'))
     return HttpResponse()